@@ -0,0 +1,367 @@
+import requests
+import os
+import shutil
+import re
+import json
+import time
+import zlib
+import hashlib
+import collections
+import atexit
+import datetime
+import threading
+import multiprocessing.util
+import numpy as np
+import request_utils
+
+
+CACHE_DIR = 'cache/pages'
+METADATA_FILE = 'cache/metadata.json'
+ARRAY_DIR = 'cache/arrays'
+MAX_CACHE_BYTES = 2 * 1024**3
+DAY = 24 * 60 * 60
+SAVE_EVERY = 100
+SAVE_INTERVAL = 30  # seconds
+# once the cache is over max_bytes, pages are evicted until it's down to
+# this share of it, so eviction runs once per batch of pages
+EVICT_TO = .9
+
+
+class PageNotCached(requests.exceptions.RequestException):
+    """
+    Raised in offline mode when a page is not in the cache.
+    """
+
+
+def page_ttl(url):
+    """
+    Return how many seconds a cached copy of the page stays fresh, or None
+    if it never expires. Final box scores and pages from past seasons never
+    change; current season schedules and game logs expire daily.
+    """
+    if '/boxes/' in url:
+        return None
+    year = re.search(r'year=(\d{4})|/(\d{4})-schedule', url)
+    if year and int(year.group(1) or year.group(2)) < datetime.date.today().year:
+        return None
+    return DAY
+
+
+class PageCache:
+    """
+    Compressed, content-addressed page cache on disk. Each page is stored
+    once under the sha256 of its content, and an index maps every url to
+    its content hash along with when it was fetched and last used. The
+    index is kept in order of last use, and once the cache grows past
+    max_bytes the least recently used pages are evicted until it's down to
+    EVICT_TO of it. The number of urls referencing each stored page and the
+    total size of the stored pages are kept up to date as urls are added
+    and dropped, so a put doesn't have to go over the whole index.
+    """
+    def __init__(self, path=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.last_saved = time.time()
+        self.index = collections.OrderedDict()
+        self.refs = collections.Counter()
+        self.total_bytes = 0
+        for url, entry in sorted(self.load_index().items(), key=lambda item: item[1]['used']):
+            self.set_entry(url, entry)
+        atexit.register(self.save_index)
+        multiprocessing.util.register_after_fork(self, PageCache.after_fork)
+
+    def after_fork(self):
+        """
+        Set the cache up in a forked worker process. Workers exit without
+        running atexit, so the index is saved by a multiprocessing finalizer
+        instead, which runs when the worker exits.
+        """
+        self.lock = threading.Lock()
+        multiprocessing.util.Finalize(self, self.save_index, exitpriority=0)
+
+    def index_file(self):
+        return os.path.join(self.path, 'index.json')
+
+    def blob_file(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def set_entry(self, url, entry):
+        """
+        Point a url at an index entry, replacing the one it had, as the most
+        recently used. Must be called while holding the lock (or before the
+        cache is shared).
+        """
+        if url in self.index:
+            self.drop_entry(url)
+        self.index[url] = entry
+        if self.refs[entry['hash']] == 0:
+            self.total_bytes += entry['size']
+        self.refs[entry['hash']] += 1
+
+    def drop_entry(self, url):
+        """
+        Remove a url from the index and return true if no other url
+        references its content anymore. Must be called while holding the
+        lock.
+        """
+        entry = self.index.pop(url)
+        self.refs[entry['hash']] -= 1
+        if self.refs[entry['hash']] > 0:
+            return False
+        del self.refs[entry['hash']]
+        self.total_bytes -= entry['size']
+        return True
+
+    def load_index(self):
+        """
+        Return the url index saved on disk, or an empty one.
+        """
+        try:
+            with open(self.index_file(), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_index(self):
+        """
+        Merge the in-memory index with the one on disk (other processes may
+        share the cache) and write it back.
+        """
+        with self.lock:
+            if not os.path.isdir(self.path):
+                return
+            on_disk = self.load_index()
+            merged = [url for url, entry in on_disk.items() if url not in self.index or entry['used'] > self.index[url]['used']]
+            for url in merged:
+                self.set_entry(url, on_disk[url])
+            if merged:
+                # entries from disk may have been used before entries already in the index
+                self.index = collections.OrderedDict(sorted(self.index.items(), key=lambda item: item[1]['used']))
+            tmp = self.index_file() + f'.{os.getpid()}.tmp'
+            # dumps encodes in one call, much faster than dump streaming to the file
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(self.index))
+            os.replace(tmp, self.index_file())
+            self.unsaved = 0
+            self.last_saved = time.time()
+
+    def get(self, url, offline=False):
+        """
+        Return the cached (content, encoding) of a url, or None if the page
+        is not cached or has expired. Expired pages are still served in
+        offline mode. The page is read outside the lock, so threads can
+        read pages at the same time.
+        """
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            ttl = page_ttl(url)
+            if not offline and ttl is not None and time.time() - entry['fetched'] > ttl:
+                return None
+            entry['used'] = time.time()
+            self.index.move_to_end(url)
+        try:
+            with open(self.blob_file(entry['hash']), 'rb') as f:
+                content = zlib.decompress(f.read())
+        except (FileNotFoundError, zlib.error):
+            with self.lock:
+                if self.index.get(url) is entry:
+                    self.drop_entry(url)
+            return None
+        return content, entry['encoding']
+
+    def put(self, url, content, encoding):
+        """
+        Store the content of a url. The page is compressed outside the lock.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        blob = self.blob_file(digest)
+        compressed = None if os.path.isfile(blob) else zlib.compress(content, 6)
+        with self.lock:
+            if not os.path.isfile(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                tmp = blob + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(compressed if compressed is not None else zlib.compress(content, 6))
+                os.replace(tmp, blob)
+            size = os.path.getsize(blob)
+            now = time.time()
+            old_entry = self.index.get(url)
+            self.set_entry(url, {'hash': digest, 'size': size, 'encoding': encoding, 'fetched': now, 'used': now})
+            # the url's old content may not be referenced anymore
+            if old_entry is not None and old_entry['hash'] not in self.refs:
+                self.remove_blob(old_entry['hash'])
+            self.evict()
+            self.unsaved += 1
+            # saving rewrites the whole index, so it's done at most every SAVE_INTERVAL
+            save = self.unsaved >= SAVE_EVERY and now - self.last_saved >= SAVE_INTERVAL
+        if save:
+            self.save_index()
+
+    def evict(self):
+        """
+        Once the cache is over max_bytes, remove the least recently used
+        pages until it fits in EVICT_TO of max_bytes. Must be called while
+        holding the lock.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        while self.index and self.total_bytes > self.max_bytes * EVICT_TO:
+            url = next(iter(self.index))
+            digest = self.index[url]['hash']
+            # the content may still be referenced by another url
+            if self.drop_entry(url):
+                self.remove_blob(digest)
+
+    def remove_blob(self, digest):
+        try:
+            os.remove(self.blob_file(digest))
+        except FileNotFoundError:
+            pass
+
+
+class MetadataCache:
+    """
+    Small JSON cache on disk for lookups that rarely change, like the teams
+    in a season or a team's roster. Entries are grouped by kind and never
+    expire; call clear() to refresh them.
+
+    cache.get('teams', '2021') --> ['ARI', 'ATL', ...]
+    """
+    def __init__(self, path=METADATA_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+        self.entries = entries
+
+    def get(self, kind, key):
+        """
+        Return the cached value, or None if there isn't one.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            return self.entries.get(kind, {}).get(key)
+
+    def put(self, kind, key, value):
+        """
+        Cache a value. The file is re-read first so entries written by other
+        processes are kept.
+        """
+        with self.lock:
+            entries = self.load()
+            entries.setdefault(kind, {})[key] = value
+            self.save(entries)
+
+    def clear(self, kind=None, key=None):
+        """
+        Forget one entry, every entry of a kind, or everything, so it is
+        looked up again the next time it's needed.
+        """
+        with self.lock:
+            entries = self.load()
+            if kind is None:
+                entries = {}
+            elif key is None:
+                entries.pop(kind, None)
+            else:
+                entries.get(kind, {}).pop(key, None)
+            self.save(entries)
+
+
+def fingerprint(values, files=None):
+    """
+    Return a hash of json-serializable values and of the size and last
+    modification time of each file, which changes whenever any of them do.
+    """
+    stats = [(file, os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in files or []]
+    return hashlib.sha1(json.dumps([values, stats]).encode()).hexdigest()[:16]
+
+
+class ArrayCache:
+    """
+    Named sets of numpy arrays saved on disk under the fingerprint of what
+    they were built from, and memory-mapped read-only when loaded. Only the
+    latest fingerprint of each name is kept.
+
+    cache.load('samples', '3f2a...') --> {'features': memmap, ...} or None
+    """
+    def __init__(self, path=ARRAY_DIR):
+        self.path = path
+
+    def folder(self, name, key):
+        return os.path.join(self.path, name, key)
+
+    def load(self, name, key):
+        """
+        Return the arrays stored under the fingerprint, or None if there
+        aren't any.
+        """
+        folder = self.folder(name, key)
+        if not os.path.isdir(folder):
+            return None
+        return {file[:-len('.npy')]: np.load(os.path.join(folder, file), mmap_mode='r')
+                for file in os.listdir(folder) if file.endswith('.npy')}
+
+    def store(self, name, key, arrays):
+        """
+        Save the arrays under the fingerprint, replacing older ones of the
+        same name, and return them memory-mapped.
+        """
+        tmp = self.folder(name, key) + f'.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp, f'{array_name}.npy'), array)
+        for old in os.listdir(os.path.join(self.path, name)):
+            if os.path.join(self.path, name, old) != tmp:
+                shutil.rmtree(os.path.join(self.path, name, old), ignore_errors=True)
+        os.replace(tmp, self.folder(name, key))
+        return self.load(name, key)
+
+
+class CachedSession(request_utils.RateLimitedSession):
+    """
+    A rate-limited session whose GET requests are served from a PageCache
+    when possible. In offline mode, pages that are not cached raise
+    PageNotCached instead of going to the network.
+    """
+    def __init__(self, rate=None, cache=None, offline=False):
+        super().__init__(rate)
+        self.cache = cache if cache is not None else PageCache()
+        self.offline = offline
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET':
+            return super().request(method, url, *args, **kwargs)
+
+        cached = self.cache.get(url, self.offline)
+        if cached is not None:
+            response = requests.models.Response()
+            response._content, response.encoding = cached
+            response.status_code = 200
+            response.url = url
+            return response
+        if self.offline:
+            raise PageNotCached(f'Not in cache (offline): {url}')
+
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(url, response.content, response.encoding)
+        return response
@@ -2,11 +2,21 @@
 from sportsipy.mlb.teams import Teams
 from sportsipy.mlb.roster import Roster, Player
 import sys
+import os
 import datetime
 import json
 import re
-import math
+import io
+import html
+import collections
+import sqlite3
+import threading
+import lxml.html
+import lxml.etree
+import numpy as np
 from colorama import Fore, Style
+import cache_utils
+import table_utils
 
 CHECK = u'\u2713'
 GREEN_CHECK = Fore.GREEN+CHECK+Style.RESET_ALL
@@ -171,6 +181,19 @@ HAS_DH = {
     'WSN': 0,
 }
 
+METADATA = cache_utils.MetadataCache()
+DATABASE_FILE = 'data/mlb.sqlite'
+ODDS_FIELDS = ['open_over_under', 'close_over_under', 'open_ou_odds']
+
+PITCHING_STATS = ['IP', 'ER', 'H', 'BB']
+PLAYOFF_SERIES = ['ALWC', 'NLWC', 'ALDS', 'NLDS', 'ALCS', 'NLCS', 'World Series']
+PLAYER_LINK = re.compile('/players/./')
+
+BoxScore = collections.namedtuple('BoxScore', [
+    'date', 'away', 'home', 'playoffs', 'suspended', 'night', 'temp',
+    'away_starter', 'home_starter', 'away_pitchers', 'home_pitchers'
+])
+
 MONTHS = {
     'Mar': 3, 
     'Apr': 4, 
@@ -209,6 +232,53 @@ def dump_data(year, file, dict):
         json.dump(dict, f, indent=4)
 
 
+def dump_checkpoint(year, checkpoint):
+    """
+    Save a season scrape checkpoint. The file is replaced in one step so an
+    interrupted write never leaves a broken checkpoint behind.
+    """
+    os.makedirs(f'data/{year}', exist_ok=True)
+    with open(f'data/{year}/checkpoint.json.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'data/{year}/checkpoint.json.tmp', f'data/{year}/checkpoint.json')
+
+
+def load_checkpoint(year):
+    """
+    Return the year's saved scrape checkpoint, or None if there isn't one.
+    """
+    if not os.path.isfile(f'data/{year}/checkpoint.json'):
+        return None
+    return load_data(year, 'checkpoint.json')
+
+
+def load_quarantine(year):
+    """
+    Return the year's list of quarantined box scores, or [] if there isn't
+    one.
+    """
+    if not os.path.isfile(f'data/{year}/quarantine.json'):
+        return []
+    return load_data(year, 'quarantine.json')
+
+
+def remove_checkpoint(year):
+    """
+    Delete the year's scrape checkpoint once the season is complete.
+    """
+    if os.path.isfile(f'data/{year}/checkpoint.json'):
+        os.remove(f'data/{year}/checkpoint.json')
+
+
+def get_game_id_date(game_id):
+    """
+    Return the date a game was played from its box score link.
+    'boxes/BOS/BOS202108170.shtml' --> '2021-08-17'
+    """
+    digits = re.search(r'(\d{4})(\d{2})(\d{2})\d\.shtml', game_id)
+    return '-'.join(digits.groups())
+
+
 def format_date_long(date_str):
     """
     Return a date string in the form of %weekday, %month %date, %year
@@ -226,70 +296,64 @@ def str_to_datetime(date_str):
     return datetime.date.fromisoformat(date_str)
 
 
-def get_starting_pitchers(soup):
+def to_game_key(date):
     """
-    Returns a len-2 list containing each starter's name and id.
-    First tuple is away, second tupule is home.
+    Return the integer key of a game from its date key: the ordinal of the
+    day times 4, plus the game number of the day.
+    '2021-08-17 (2)' --> 2952078
+    """
+    day = datetime.date.fromisoformat(date[:10]).toordinal()
+    return day*4 + (2 if date.endswith('(2)') else 1)
+
 
-    [('Lucas Giolito', 'giolilu01'), ('Dylan Bundy', 'bundydy01')]
+def from_game_key(key):
     """
-    lineups = str(soup.find('div', id='all_lineups')).split('\n')
-    starters = []
-    for i in range(len(lineups)):
-        if '<td>P</td>' in lineups[i]:
-            # <td><a href="players/w/wilsocj01.shtml">C.J. Wilson</a></td><td>P</td>
-            line = lineups[i-1].strip()
-            shtml = line.find('.shtml')
-            name = line[shtml+8:line.find('<', shtml)]
-            find_name = re.search(re.compile('/players/./'), line)
-            if find_name == None:
-                starters.append(('not_found', 'not_found'))
-                continue
-            id = line[find_name.span()[1]:shtml]
-            starters.append((name, id))
-            if len(starters) == 2:
-                break
-    # no <td>P</td> tags at all
-    if len(starters) < 2:
-        return [('not_found', 'not_found'), ('not_found', 'not_found')]
-    return starters[0], starters[1]
+    Return the date key of a game from its integer key.
+    2952078 --> '2021-08-17 (2)'
+    """
+    day, number = divmod(key, 4)
+    date = str(datetime.date.fromordinal(day))
+    return date if number == 1 else f'{date} ({number})'
 
 
-def has_team_totals(line):
+def game_key_day(key):
     """
-    Return true if keywords that indicate the end of a pitching table
-    has been reached are found.
+    Return the ordinal of the day a game was played from its key.
     """
-    return 'Team Totals' in line and 'data-stat="ER"' in line
+    return key // 4
 
 
-def get_night_game(game_page):
+def game_key_year(key):
     """
-    Returns true if the game took place at night (7:00 pm local start)
+    Return the season of a game from its key, as a string.
+    2952078 --> '2021'
     """
-    return float(game_page.find(text=re.compile('Night Game')) != None)
+    return str(datetime.date.fromordinal(key // 4).year)
 
 
-def get_temperature(game_page):
+def parse_lineup_starter(line):
     """
-    Parse for and return the game time temperature.
+    Return the (name, id) of the pitcher listed on a line of the starting
+    lineups table.
+
+    '<td><a href="/players/w/wilsocj01.shtml">C.J. Wilson</a></td>' --> ('C.J. Wilson', 'wilsocj01')
     """
-    weather = game_page.find('', text=re.compile('&deg'))
-    degrees = weather.find('&deg')
-    temp = int(weather[degrees-3:degrees].strip())
-    return temp
+    line = line.strip()
+    shtml = line.find('.shtml')
+    name = line[shtml+8:line.find('<', shtml)]
+    find_name = re.search(PLAYER_LINK, line)
+    if find_name == None:
+        return ('not_found', 'not_found')
+    id = line[find_name.span()[1]:shtml]
+    return (name, id)
 
 
-def is_playoffs(soup):
+def has_team_totals(line):
     """
-    Returns true if the game is playoff game.
+    Return true if keywords that indicate the end of a pitching table
+    has been reached are found.
     """
-    title = soup.title.text
-    playoffs = ['ALWC', 'NLWC', 'ALDS', 'NLDS', 'ALCS', 'NLCS', 'World Series']
-    for series in playoffs:
-        if series in title:
-            return True
-    return False
+    return 'Team Totals' in line and 'data-stat="ER"' in line
 
 
 def is_pitching_row(line):
@@ -300,52 +364,171 @@ def is_pitching_row(line):
     return ('data-stat="IP"' in line and 'data-append-csv' in line) or ('Team Totals' in line and 'data-stat="ER"' in line)
 
 
-def was_suspended(soup):
+def parse_pitcher_stats(line):
+    """
+    Parse a line in the boxscore page for pitcher stats. Return a map of each 
+    pitcher's stats for that game.
+    """
+    csv = line.find('data-append-csv="')+17
+    player_id = line[csv : line.find('"', csv)].strip()
+    shtml = line.find('.shtml')
+    player_name = line[line.find('>', shtml)+1:line.find('<', shtml)].strip()
+    game_stats = {
+        'name': player_name,
+        'id': player_id, 
+    }
+    for stat in PITCHING_STATS:
+        i = line.find(f'data-stat="{stat}"')
+        num = float(line[line.find('>', i)+1:line.find('<', i)].strip())
+        game_stats[stat] = num
+    game_stats['outs'] = ip_to_outs(game_stats['IP'])
+    
+    return game_stats
+
+
+def parse_temperature(line):
     """
-    Returns true if the game was suspended.
+    Return the game time temperature from the line containing the weather.
     """
-    scorebox = soup.find('div', class_='scorebox_meta').text
-    return 'suspended' in scorebox
+    degrees = line.find('&deg')
+    return int(line[max(0, degrees-3):degrees].strip())
 
 
-def get_stat_value(row, stat):
+def parse_box_score(page):
     """
-    Return the value of a particular stat from a game log row.
+    Extract everything needed from a box score page in a single pass over its 
+    lines and return a BoxScore. The title, scorebox meta, weather, starting
+    lineups and both pitching tables (which are inside html comments) are 
+    picked up as the lines go by.
+
+    Playoff and suspended games are returned with only those flags set.
     """
-    if stat in STAT_CHANGES:
-        stat = STAT_CHANGES[stat]
+    title = None
+    meta = []
+    meta_depth = 0
+    meta_done = False
+    in_lineups = False
+    lineup_depth = 0
+    starters = []
+    night = 0.0
+    temp = None
+    pitchers = ([], [])
+    team_totals = 0
+    prev_line = ''
+
+    for line in io.StringIO(page):
+        if title is None and '<title>' in line:
+            title = html.unescape(line[line.find('<title>')+7:line.find('</title>')])
+
+        # the first scorebox_meta div says if the game was suspended or the second of a doubleheader
+        if not meta_done and (meta_depth > 0 or 'class="scorebox_meta"' in line):
+            meta.append(line)
+            meta_depth += line.count('<div') - line.count('</div')
+            meta_done = meta_depth <= 0
+
+        if 'id="all_lineups"' in line:
+            in_lineups = True
+        if in_lineups:
+            lineup_depth += line.count('<div') - line.count('</div')
+            if '<td>P</td>' in line and len(starters) < 2:
+                starters.append(parse_lineup_starter(prev_line))
+            in_lineups = lineup_depth > 0
+
+        if 'Night Game' in line:
+            night = 1.0
+        if temp is None and '&deg' in line:
+            temp = parse_temperature(line)
+
+        if team_totals < 2 and is_pitching_row(line):
+            if has_team_totals(line):
+                team_totals += 1
+            else:
+                pitchers[team_totals].append(parse_pitcher_stats(line))
+        prev_line = line
+
+    meta = re.sub('<[^>]+>', '', ''.join(meta))
+    playoffs = any(series in title for series in PLAYOFF_SERIES)
+    suspended = 'suspended' in meta
+    if playoffs or suspended:
+        return BoxScore(None, None, None, playoffs, suspended, None, None, None, None, None, None)
+
+    date, away_abbr, home_abbr = parse_title(title)
+    if 'Second game of doubleheader' in meta:
+        date += ' (2)'
+    # no <td>P</td> tags at all
+    if len(starters) < 2:
+        starters = [('not_found', 'not_found'), ('not_found', 'not_found')]
+    if temp is None:
+        raise ValueError(f'No weather found in box score: {title}')
+    return BoxScore(date, away_abbr, home_abbr, playoffs, suspended, night, temp, starters[0], starters[1], pitchers[0], pitchers[1])
 
-    if stat == 'opposing_starter':
-        name = row.find('td', {'data-stat': stat}).text.strip()
-        return name[:name.find('(')]
-    elif stat == 'opposing_starter_throws':
-        return int(row.find('td', {'data-stat': stat}).text.strip() == 'R')
-    elif stat == 'team_homeORaway':
-        return int(row.find('td', {'data-stat': stat}).text.strip() == '@')
-    elif stat == 'date_game':
-        return row.find_all('td')[1]['csk'].split('.')[0]
-    elif stat == 'opp_ID':
-        return row.find('td', {'data-stat': stat}).text
-    else:
-        try:
-            return int(row.find('td', {'data-stat': stat}).text)
-        except:
-            return float(row.find('td', {'data-stat': stat}).text)
+
+def to_number(text):
+    """
+    Return the int or float value of a table cell's text.
+    """
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
 
 
-def game_suspended(game):
+def parse_opposing_starter(cell):
     """
-    Return true if the game was suspended. Used for hitting game logs.
+    'Y.Darvish(1-0)' --> 'Y.Darvish'
     """
-    return 'suspended' in str(game)
+    name = cell.text_content().strip()
+    return name[:name.find('(')]
+
+
+GAMELOG_CONVERTERS = {
+    'date_game': lambda cell: cell.get('csk').split('.')[0],
+    'opp_ID': lambda cell: cell.text_content(),
+    'opposing_starter': parse_opposing_starter,
+    'opposing_starter_throws': lambda cell: int(cell.text_content().strip() == 'R'),
+    'team_homeORaway': lambda cell: int(cell.text_content().strip() == '@'),
+}
+
+
+# true if 'suspended' is in any text or attribute of a game log row, like the
+# '(suspended)' note baseball-reference adds to the date of suspended games
+IS_SUSPENDED = lxml.etree.XPath('boolean(.//text()[contains(., "suspended")] | .//@*[contains(., "suspended")])')
 
 
-def is_second_game(soup):
+def parse_gamelog_table(page, table_id, stats):
     """
-    Returns true if the game is the second of a doubleheader.
+    Parse a team game log table (batting or pitching) in a single pass and 
+    return a dict of typed columns, one for each stat:
+
+    {'date': ['2021-04-02', '2021-04-03', ...], 'H': [7, 12, ...], ...}
+
+    The header is read once to find which column each stat is in, then each
+    row's cells are converted by position. Repeated header rows and 
+    suspended games are skipped.
     """
-    scorebox = soup.find('div', class_='box').find('div', class_='scorebox').find('div', class_='scorebox_meta').text
-    return 'Second game of doubleheader' in scorebox
+    doc = lxml.html.fromstring(page)
+    table = doc.get_element_by_id(table_id)
+    if table.tag != 'table':
+        table = table.find('.//table')
+
+    header = table.xpath('./thead/tr[last()]/th')
+    positions = {th.get('data-stat'): i for i, th in enumerate(header)}
+    columns = []
+    for stat in stats:
+        data_stat = STAT_CHANGES.get(stat, stat)
+        columns.append((stat, positions[data_stat], GAMELOG_CONVERTERS.get(data_stat)))
+
+    table_data = {stat: [] for stat in stats}
+    for row in table.xpath('./tbody/tr'):
+        if 'thead' in row.get('class', ''):
+            continue
+        if IS_SUSPENDED(row):
+            continue
+        cells = row.getchildren()
+        for stat, position, convert in columns:
+            cell = cells[position]
+            table_data[stat].append(convert(cell) if convert else to_number(cell.text_content()))
+    return table_data
 
 
 def parse_title(title):
@@ -365,19 +548,41 @@ def parse_title(title):
     return date, TEAM_ABBRS[away_name], TEAM_ABBRS[home_name]
     
 
+def ip_to_outs(innings_pitched):
+    """
+    Convert innings pitched in conventional format to outs.
+    5.1 --> 16
+    """
+    tenths = round(abs(innings_pitched)*10)
+    outs = tenths//10*3 + tenths%10
+    return -outs if innings_pitched < 0 else outs
+
+
+def outs_to_IP(outs):
+    """
+    Convert outs to innings pitched in conventional format.
+    16 --> 5.1
+    """
+    if outs < 0:
+        return -outs_to_IP(-outs)
+    return round(outs//3 + (outs%3)/10, 1)
+
+
+def outs_to_innings(outs):
+    """
+    Convert outs to innings as a standard decimal.
+    16 --> 5.33
+    """
+    return outs//3 + (outs%3)/3
+
+
 def add_IP(one, two):
     """
     Add or subtract innings pitched. 
     5.1 + 8.2 = 14.0 IP
     4.1 - 1.2 = 2.2 IP
     """
-    sum = round(one + two, 2)
-    tenth = int(str(sum).split('.')[-1])
-    if 2 < tenth < 8:
-        sum = float(math.ceil(sum) + (tenth % 3)/10)
-    if tenth == 8 or tenth == 9:
-        sum = float(math.floor(sum) + (3-(10-tenth))/10)
-    return sum
+    return outs_to_IP(ip_to_outs(one) + ip_to_outs(two))
 
 
 def to_decimal(innings_pitched):
@@ -385,50 +590,106 @@ def to_decimal(innings_pitched):
     Convert conventional IP format to standard decimals.
     5.1 --> 5.33
     """
-    tenth = float(str(float(innings_pitched)).split('.')[-1])
-    return math.floor(innings_pitched) + tenth/3
+    return outs_to_innings(ip_to_outs(innings_pitched))
+
+
+def round_stat(value, digits):
+    """
+    Round a stat the way round() does, for a number or an array of them.
+    np.rint can land on the other side of a tie than round() does, because
+    scaling by 10**digits isn't exact, so array values that are within a
+    hair of a tie are rounded one at a time.
+    """
+    if not isinstance(value, np.ndarray):
+        return round(value, digits)
+    scaled = value * 10**digits
+    rounded = np.rint(scaled) / 10**digits
+    near_tie = np.abs(scaled - np.floor(scaled) - .5) < 1e-6
+    for i in np.flatnonzero(near_tie):
+        rounded[i] = round(float(value[i]), digits)
+    return rounded
+
+
+def divide(numerator, denominator):
+    """
+    Divide numbers or arrays. Array entries with a zero denominator are nan,
+    while numbers raise ZeroDivisionError as usual.
+    """
+    if not isinstance(numerator, np.ndarray) and not isinstance(denominator, np.ndarray):
+        return numerator/denominator
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quotient = np.true_divide(numerator, denominator)
+    return np.where(denominator == 0, np.nan, quotient)
 
 
-def calculate_ERA(earned_runs, innings_pitched):
+def calculate_ERA(earned_runs, outs):
     """
-    Return earned-run-average from earned runs and innings pitched.
+    Return earned-run-average from earned runs and outs recorded. Also takes
+    arrays of each.
     """
-    return round(earned_runs*9/to_decimal(innings_pitched), 2)
+    return round_stat(divide(earned_runs*9, outs_to_innings(outs)), 2)
 
 
-def calculate_WHIP(innings_pitched, walks, hits):
+def calculate_WHIP(outs, walks, hits):
     """
-    Return WHIP.
+    Return WHIP from outs recorded, walks and hits. Also takes arrays of each.
     """
-    return round((walks+hits)/to_decimal(innings_pitched), 2)
+    return round_stat(divide(walks+hits, outs_to_innings(outs)), 2)
+
+
+def add_outs(pitcher_data=None, bullpen_data=None):
+    """
+    Add the `outs` field to stored pitcher appearances and the `game_outs`
+    field to stored bullpen games that predate them, computed from the 
+    conventional IP fields.
+    """
+    for appearances in (pitcher_data or {}).values():
+        for game in appearances.values():
+            if 'outs' not in game:
+                game['outs'] = ip_to_outs(game['IP'])
+    for team_bullpen in (bullpen_data or {}).values():
+        for game in team_bullpen.values():
+            if 'game_outs' not in game:
+                game['game_outs'] = ip_to_outs(game['game_IP'])
+
+
+def migrate_outs(year):
+    """
+    Rewrite the year's stored pitcher and bullpen data with the outs fields.
+    """
+    pitcher_data = load_data(year, 'pitcher-data.json')
+    bullpen_data = load_data(year, 'team-bullpen-data.json')
+    add_outs(pitcher_data, bullpen_data)
+    dump_data(year, 'pitcher-data.json', pitcher_data)
+    dump_data(year, 'team-bullpen-data.json', bullpen_data)
 
 
 def calculate_BA(at_bats, hits):
     """
-    Return batting average.
+    Return batting average. Also takes arrays of each.
     """
-    return round(hits/at_bats, 3)
+    return round_stat(divide(hits, at_bats), 3)
 
 
 def calculate_OBP(hits, walks, hbp, at_bats, sac_fly):
     """
-    Return on-base percentage.
+    Return on-base percentage. Also takes arrays of each.
     """
-    return round((hits+walks+hbp)/(at_bats+sac_fly+hbp+walks), 3)
+    return round_stat(divide(hits+walks+hbp, at_bats+sac_fly+hbp+walks), 3)
 
 
 def calculate_SLG(singles, doubles, triples, homeruns, at_bats):
     """
-    Return slugging percentage.
+    Return slugging percentage. Also takes arrays of each.
     """
-    return round((singles+2*doubles+3*triples+4*homeruns)/at_bats, 3)
+    return round_stat(divide(singles+2*doubles+3*triples+4*homeruns, at_bats), 3)
 
 
 def calculate_OPS(obp, slg):
     """
-    Return on-base plus slugging percentage.
+    Return on-base plus slugging percentage. Also takes arrays of each.
     """
-    return round(obp + slg, 3)
+    return round_stat(obp + slg, 3)
 
 
 def get_day_before(date):
@@ -438,19 +699,33 @@ def get_day_before(date):
     return str(date - datetime.timedelta(1)).split()[0]
 
 
-def get_team_abbreviations(year):
+def get_team_abbreviations(year, refresh=False):
     """
-    Return a list of all the MLB team abbreviations for the given year.
+    Return a list of all the MLB team abbreviations for the given year. The
+    list is only looked up once, then read from the metadata cache unless
+    refresh is set.
     """
-    return sorted([team.abbreviation for team in Teams(year)])
+    teams = None if refresh else METADATA.get('teams', str(year))
+    if teams is None:
+        teams = sorted([team.abbreviation for team in Teams(year)])
+        METADATA.put('teams', str(year), teams)
+    return teams
 
 
-def starter_verified(last_name, full_name):
+def get_roster(team_abbr, year=None, refresh=False):
     """
-    Return true if the given last name appears in the starter's full name.
-    ('Snell', 'Blake Snell') --> True
+    Return a map of player ID to name for each player on a team's roster for
+    the given year (this season by default). Rosters are only looked up
+    once, then read from the metadata cache unless refresh is set.
     """
-    return last_name.lower() in full_name.lower()
+    year = str(year or datetime.date.today().year)
+    key = f'{team_abbr}-{year}'
+    roster = None if refresh else METADATA.get('rosters', key)
+    if roster is None:
+        # slim rosters come from the one team page instead of every player's page
+        roster = Roster(team_abbr, year, slim=True).players
+        METADATA.put('rosters', key, roster)
+    return roster
 
 
 def print_same_line(message):
@@ -460,6 +735,19 @@ def print_same_line(message):
     print(LINE_UP, end=LINE_CLEAR)
 
 
+def print_progress(progress, first=False):
+    """
+    Print one line per key of the progress dict, overwriting the lines 
+    printed by the previous call.
+
+    {'2021': 'BOS (162 games) ✓', '2022': '2022-05-03 - NYY @ TOR ✓'}
+    """
+    if not first:
+        print(LINE_UP*len(progress), end='')
+    for key in progress:
+        print(f'{LINE_CLEAR}{Style.BRIGHT}{key}{Style.RESET_ALL}: {progress[key]}')
+
+
 def get_stadium_score(team, game):
     """
     """
@@ -468,49 +756,302 @@ def get_stadium_score(team, game):
     return STADIUM_SCORES[game['opp']]
 
 
+def get_appearance(pitcher_data, year, id, date):
+    """
+    Return a pitcher's appearance from pitcher_data, or from the database
+    if a GameDatabase is passed in its place. Raises KeyError if there is
+    no such appearance.
+    """
+    if isinstance(pitcher_data, GameDatabase):
+        appearance = pitcher_data.get_appearance(id, date)
+        if appearance is None:
+            raise KeyError((id, date))
+        return appearance
+    return pitcher_data[year][id][date]
+
+
+def get_bullpen_game(bullpen_data, year, team_abbr, date):
+    """
+    Return a team's bullpen game from bullpen_data, or from the database if
+    a GameDatabase is passed in its place. Raises KeyError if there is no
+    such game.
+    """
+    if isinstance(bullpen_data, GameDatabase):
+        game = bullpen_data.get_bullpen(team_abbr, date)
+        if game is None:
+            raise KeyError((team_abbr, date))
+        return game
+    return bullpen_data[year][team_abbr][date]
+
+
 def get_pitcher_ERA(pitcher_data, year, id, date):
     """
     Return a pitcher's pregame ERA.
     """
-    return pitcher_data[year][id][date]['pregame_ERA']
+    return get_appearance(pitcher_data, year, id, date)['pregame_ERA']
 
 
 def get_pitcher_WHIP(pitcher_data, year, id, date):
     """
     Return a pitcher's pregame WHIP.
     """
-    return pitcher_data[year][id][date]['pregame_WHIP']
+    return get_appearance(pitcher_data, year, id, date)['pregame_WHIP']
 
 
 def get_bullpen_ERA(bullpen_data, year, team_abbr, date):
     """
     Return a team's bullpen pregame ERA.
     """
-    return bullpen_data[year][team_abbr][date]['pregame_ERA']
+    return get_bullpen_game(bullpen_data, year, team_abbr, date)['pregame_ERA']
 
 
 def get_bullpen_WHIP(bullpen_data, year, team_abbr, date):
     """
     Return a team's bullpen pregame WHIP.
     """
-    return bullpen_data[year][team_abbr][date]['pregame_WHIP']
+    return get_bullpen_game(bullpen_data, year, team_abbr, date)['pregame_WHIP']
+
+
+class GameIndex:
+    """
+    Integer keys for the loaded data of each year, built for a year the
+    first time one of its games is looked up. Each team's game keys are
+    kept in order, and every (team, key), (pitcher, key) and bullpen
+    (team, key) maps to the row holding it. Seasons held in a RecordTable
+    (see table_utils) already find their rows by key, so they are looked
+    up in the table rather than copied into the index.
+
+    index.team_keys['2021']['BOS'] --> [2951525, 2951529, ...]
+    index.get_appearance('2021', 'salech01', 2951525) --> {'IP': 5.0, ...}
+    """
+    def __init__(self, game_data, pitcher_data, bullpen_data):
+        self.game_data, self.pitcher_data, self.bullpen_data = game_data, pitcher_data, bullpen_data
+        self.team_keys = {}
+        self.games, self.game_rows = {}, {}
+        self.appearances, self.appearance_rows = {}, {}
+        self.bullpens, self.bullpen_rows = {}, {}
+
+    def index_year(self, year):
+        """
+        Build the index of a year's data unless it has been built already.
+        """
+        if year in self.team_keys:
+            return
+        game_data = self.game_data[year]
+        self.games[year], self.game_rows[year] = self.index_rows(game_data)
+        self.appearances[year], self.appearance_rows[year] = self.index_rows(self.pitcher_data.get(year, {}))
+        self.bullpens[year], self.bullpen_rows[year] = self.index_rows(self.bullpen_data.get(year, {}))
+        if isinstance(game_data, table_utils.RecordTable):
+            self.team_keys[year] = {team: game_data.keys[game_data.get_rows(team)].tolist() for team in game_data}
+        else:
+            self.team_keys[year] = {team: [to_game_key(date) for date in games] for team, games in game_data.items()}
+
+    def evict(self, year=None):
+        """
+        Drop the index of a year, or of every year.
+        """
+        for index in [self.team_keys, self.games, self.game_rows, self.appearances,
+                      self.appearance_rows, self.bullpens, self.bullpen_rows]:
+            if year is None:
+                index.clear()
+            else:
+                index.pop(year, None)
+
+    @staticmethod
+    def index_rows(season_data):
+        """
+        Return the records of a season's data in one list, and a map of 
+        (name, key) to the row of each record. A RecordTable is returned as
+        is, with no map.
+        """
+        if isinstance(season_data, table_utils.RecordTable):
+            return season_data, None
+        rows, row_index = [], {}
+        for name, records in season_data.items():
+            for date, record in records.items():
+                row_index[(name, to_game_key(date))] = len(rows)
+                rows.append(record)
+        return rows, row_index
+
+    @staticmethod
+    def get_record(rows, row_index, name, key):
+        if row_index is None:
+            row = rows.get_row(name, key)
+            return None if row is None else table_utils.RecordView(rows, row)
+        row = row_index.get((name, key))
+        return None if row is None else rows[row]
+
+    def get_game(self, year, team, key):
+        self.index_year(year)
+        return self.get_record(self.games[year], self.game_rows[year], team, key)
+
+    def get_appearance(self, year, pitcher, key):
+        self.index_year(year)
+        return self.get_record(self.appearances[year], self.appearance_rows[year], pitcher, key)
+
+    def get_bullpen(self, year, team, key):
+        self.index_year(year)
+        return self.get_record(self.bullpens[year], self.bullpen_rows[year], team, key)
+
+    def get_team_games(self, year, team):
+        """
+        Return a list of (key, game) for each of a team's games in order.
+        """
+        self.index_year(year)
+        if self.game_rows[year] is None:
+            table = self.games[year]
+            start, end = table.row_ranges[team]
+            return [(key, table_utils.RecordView(table, row)) for row, key in zip(range(start, end), self.team_keys[year][team])]
+        return [(key, self.get_game(year, team, key)) for key in self.team_keys[year][team]]
+
+
+class GameDatabase:
+    """
+    Optional SQLite copy of the stored data, for looking up single games,
+    appearances and bullpen games, or a range of dates, without loading
+    whole seasons. Each record is kept as json next to the columns it's
+    indexed by; the date column holds the same keys as the json files.
+    The database runs in WAL mode so it can be read while a scrape writes.
+
+    db = GameDatabase()
+    db.get_game('BOS', '2021-08-17 (2)') --> {'AB': 34, ...}
+    db.get_appearances('verlaju01', '2019-04-01', '2019-04-30') --> [('2019-04-03', {...}), ...]
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS games (year TEXT, team TEXT, date TEXT, key INTEGER, stats TEXT)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS games_team_date ON games (year, team, date)',
+        'CREATE TABLE IF NOT EXISTS appearances (year TEXT, pitcher_id TEXT, date TEXT, key INTEGER, stats TEXT)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS appearances_pitcher_date ON appearances (pitcher_id, date)',
+        'CREATE TABLE IF NOT EXISTS bullpens (year TEXT, team TEXT, date TEXT, key INTEGER, stats TEXT)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS bullpens_team_date ON bullpens (year, team, date)',
+        'CREATE TABLE IF NOT EXISTS odds (year TEXT, team TEXT, date TEXT, open_over_under, close_over_under, open_ou_odds)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS odds_team_date ON odds (year, team, date)',
+    ]
+
+    def __init__(self, path=DATABASE_FILE):
+        self.path = path
+        self.local = threading.local()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def connect(self):
+        """
+        Return this thread's connection, opening it first if needed.
+        """
+        if getattr(self.local, 'connection', None) is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+            self.local.connection = connection
+        return self.local.connection
+
+    def close(self):
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    @staticmethod
+    def to_rows(year, season_data):
+        return [(year, name, date, to_game_key(date), json.dumps(record))
+                for name, records in season_data.items() for date, record in records.items()]
+
+    def add_season(self, year, game_data, pitcher_data, bullpen_data):
+        """
+        Write a season's data, replacing what was stored for it, in one
+        transaction. Odds already merged into the games are stored too.
+        """
+        year = str(year)
+        connection = self.connect()
+        with connection:
+            self.write_games(connection, year, game_data)
+            for table in ['appearances', 'bullpens']:
+                connection.execute(f'DELETE FROM {table} WHERE year = ?', (year,))
+            connection.executemany('INSERT INTO appearances VALUES (?, ?, ?, ?, ?)', self.to_rows(year, pitcher_data))
+            connection.executemany('INSERT INTO bullpens VALUES (?, ?, ?, ?, ?)', self.to_rows(year, bullpen_data))
+
+    def add_games(self, year, game_data):
+        """
+        Write a season's games and their odds, replacing the stored ones.
+        """
+        connection = self.connect()
+        with connection:
+            self.write_games(connection, str(year), game_data)
+
+    def write_games(self, connection, year, game_data):
+        # odds read with pandas can be numpy scalars, which sqlite can't store
+        odds = [(year, team, date, *[game[field].item() if isinstance(game[field], np.generic) else game[field]
+                                     for field in ODDS_FIELDS])
+                for team, games in game_data.items() for date, game in games.items()
+                if all(field in game for field in ODDS_FIELDS)]
+        for table in ['games', 'odds']:
+            connection.execute(f'DELETE FROM {table} WHERE year = ?', (year,))
+        connection.executemany('INSERT INTO games VALUES (?, ?, ?, ?, ?)', self.to_rows(year, game_data))
+        connection.executemany('INSERT INTO odds VALUES (?, ?, ?, ?, ?, ?)', odds)
+
+    def get_record(self, table, column, name, date):
+        # appearances are indexed by (pitcher_id, date), the rest by (year, team, date)
+        if table == 'appearances':
+            row = self.connect().execute(f'SELECT stats FROM {table} WHERE {column} = ? AND date = ?',
+                                         (name, date)).fetchone()
+        else:
+            row = self.connect().execute(f'SELECT stats FROM {table} WHERE year = ? AND {column} = ? AND date = ?',
+                                         (date[:4], name, date)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_records(self, table, column, name, start, end):
+        # ' (2)' sorts after a date, so the end date's doubleheader is included
+        if table == 'appearances':
+            rows = self.connect().execute(f'SELECT date, stats FROM {table} WHERE {column} = ? AND date BETWEEN ? AND ? '
+                                          'ORDER BY date', (name, start, end + ' (2)'))
+        else:
+            rows = self.connect().execute(f'SELECT date, stats FROM {table} WHERE year BETWEEN ? AND ? AND {column} = ? '
+                                          'AND date BETWEEN ? AND ? ORDER BY date', (start[:4], end[:4], name, start, end + ' (2)'))
+        return [(date, json.loads(stats)) for date, stats in rows]
 
+    def get_game(self, team, date):
+        return self.get_record('games', 'team', team, date)
 
-def get_data_dicts(start_year, end_year):
-    """
-    Load the data for each year into separate dictionaries and return 
-    them. 
-    """
-    game_data = {}
-    pitcher_data = {}
-    bullpen_data = {}
-    years = [str(year) for year in range(start_year, end_year+1) if year != 2020]
-    for year in years:  
-        game_data[year] = load_data(year, 'game-data.json')
-        pitcher_data[year] = load_data(year, 'pitcher-data.json')
-        bullpen_data[year] = load_data(year, 'team-bullpen-data.json')
+    def get_appearance(self, pitcher_id, date):
+        return self.get_record('appearances', 'pitcher_id', pitcher_id, date)
+
+    def get_bullpen(self, team, date):
+        return self.get_record('bullpens', 'team', team, date)
+
+    def get_team_games(self, team, start, end):
+        """
+        Return a list of (date, game) for a team's games from start through
+        end, doubleheaders included, in order.
+        """
+        return self.get_records('games', 'team', team, start, end)
 
-    return game_data, pitcher_data, bullpen_data
+    def get_appearances(self, pitcher_id, start, end):
+        return self.get_records('appearances', 'pitcher_id', pitcher_id, start, end)
+
+    def get_bullpen_games(self, team, start, end):
+        return self.get_records('bullpens', 'team', team, start, end)
+
+    def get_most_recent_game(self, team):
+        """
+        Return the (date, game) of a team's last stored game, or None.
+        """
+        row = self.connect().execute('SELECT date, stats FROM games WHERE year = (SELECT MAX(year) FROM games '
+                                     'WHERE team = ?) AND team = ? ORDER BY date DESC LIMIT 1', (team, team)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def get_odds(self, team, date):
+        """
+        Return a game's odds as a dict of ODDS_FIELDS, or None.
+        """
+        row = self.connect().execute(f'SELECT {", ".join(ODDS_FIELDS)} FROM odds WHERE year = ? AND team = ? AND date = ?',
+                                     (date[:4], team, date)).fetchone()
+        return None if row is None else dict(zip(ODDS_FIELDS, row))
+
+
+DATABASE = GameDatabase()
 
 
 def has_DH(team, year):
@@ -522,7 +1063,7 @@ def has_DH(team, year):
     return HAS_DH[team]
 
 
-def get_pitcher_ID(team_abbr, name):
+def get_pitcher_ID(team_abbr, name, year=None):
     """
     Return the ID of the player given his first initial, last name, 
     and team.
@@ -532,7 +1073,7 @@ def get_pitcher_ID(team_abbr, name):
 
     first_initial, last_name = name.split('.')
     id_name = last_name[:min(5, len(last_name))]
-    roster = [player.player_id for player in Roster(team_abbr).players]
+    roster = list(get_roster(team_abbr, year))
     player_id = []
     for id in roster:
         if id_name + first_initial in id:
@@ -547,17 +1088,15 @@ def get_pitcher_ID(team_abbr, name):
     return player_id[0]
 
 
-def get_weekdays(date):
+def get_weekdays(key):
     """
     Return a list of weekdays filled with zeros, except a 1 in the 
-    column of the weekday the date falls on. 0-index is Monday.
-    """
-    values = []
-    date_str = date if '(' not in date else date[:date.find('(')].strip()
-    for day in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
-        weekday = datetime.date.fromisoformat(date_str).strftime('%A')
-        if day == weekday:
-            values.append(1)
-        else:
-            values.append(0)
+    column of the weekday the game falls on. 0-index is Monday. Takes a 
+    game key or a date string.
+    """
+    if isinstance(key, str):
+        key = to_game_key(key)
+    values = [0] * 7
+    # day 1 (0001-01-01) was a Monday
+    values[(game_key_day(key)-1) % 7] = 1
     return values
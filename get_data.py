@@ -1,37 +1,48 @@
 
 from bs4 import BeautifulSoup
-import requests
 import datetime
 import sys, os
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from colorama import Fore, Style
-import data_utils, model
+import data_utils, stats_utils, state_utils, storage_utils, request_utils, cache_utils, model
 
 
-PITCHING_STATS = ['IP', 'ER', 'H', 'BB']
+PITCHING_STATS = data_utils.PITCHING_STATS
 HITTING_STATS = ['AB', 'R', 'H', '2B', '3B', 'HR', 'RBI', 'BB', 'HBP', 'SF', 'postgame_BA', 'postgame_OBP', 'postgame_SLG', 'postgame_OPS']
 GAME_STATS = ['date', 'home', 'opp', 'opp_starter_righty', 'opp_starter']
 ALL_STATS = GAME_STATS + HITTING_STATS
 
-SESSION = requests.Session()
+WORKERS = 1
+PROCESSES = 1
+CHECKPOINT_EVERY = 100
+REQUESTS_PER_SECOND = 10
+PROGRESS_QUEUE = None
+SEASON_YEAR = None
+
+SESSION = cache_utils.CachedSession(REQUESTS_PER_SECOND)
 TODAY = datetime.date.today()
 
 
-def remove_headers(soup):
+def report(message):
     """
-    Removes the repetitive stat headers that occur throughout the season table
+    Show a progress message, or send it to the parent process when running
+    as a season worker.
     """
-    headers = soup.find_all('tr', class_='thead')
-    for header in headers:
-        header.extract()
+    if PROGRESS_QUEUE is None:
+        data_utils.print_same_line(message)
+    else:
+        PROGRESS_QUEUE.put((SEASON_YEAR, message))
 
 
-def add_yesterday_off(box_score, season_games):
+def add_yesterday_off(box_score, played_days):
     """
-    Adds whether or not the specified team had an off day.
+    Adds whether or not the specified team had an off day, given the set of
+    days (game_key_day) the team has played on so far.
     """
-    date = data_utils.str_to_datetime(box_score['date'])
-    day_before = data_utils.get_day_before(date)
-    box_score['yesterday_off'] = int(day_before not in season_games)
+    day = data_utils.game_key_day(data_utils.to_game_key(box_score['date']))
+    box_score['yesterday_off'] = int(day-1 not in played_days)
     return box_score
 
 
@@ -44,27 +55,6 @@ def add_is_night_game(season_games, team_abbr, date, is_night):
     season_games[opp_abbr][date]['night'] = is_night
 
 
-def parse_pitcher_stats(line):
-    """
-    Parse a line in the boxscore page for pitcher stats. Return a map of each 
-    pitcher's stats for that game.
-    """
-    csv = line.find('data-append-csv="')+17
-    player_id = line[csv : line.find('"', csv)].strip()
-    shtml = line.find('.shtml')
-    player_name = line[line.find('>', shtml)+1:line.find('<', shtml)].strip()
-    game_stats = {
-        'name': player_name,
-        'id': player_id, 
-    }
-    for stat in PITCHING_STATS:
-        i = line.find(f'data-stat="{stat}"')
-        num = float(line[line.find('>', i)+1:line.find('<', i)].strip())
-        game_stats[stat] = num
-    
-    return game_stats
-
-
 def add_pitcher_stats(stats, team, opp, date, season_pitching, season_games):
     """
     Adds a pitcher's game stats to the dictionary containing all of the pitcher
@@ -85,7 +75,7 @@ def add_pitcher_stats(stats, team, opp, date, season_pitching, season_games):
          'opp': opp,
     }
     # load the pitcher's stats into the dict
-    for category in PITCHING_STATS:
+    for category in PITCHING_STATS + ['outs']:
         season_pitching[player_id][date][category] = stats[category]
 
     # add the pitcher info to the data for the opponent's game
@@ -97,90 +87,66 @@ def add_pitcher_stats(stats, team, opp, date, season_pitching, season_games):
     game['opp_pitchers'].append(player_id)
 
 
-def get_bullpen_stats(season_games, pitcher_data, team_abbr, year):
+def get_bullpen_stats(season_games, pitcher_data, team_abbr, team_bullpen=None):
     """
-    Calculate ERA and WHIP for a team's bullpen prior to the start of each game
-    and return a map containing the information. 
+    Add a team's bullpen line for each game that isn't in team_bullpen yet
+    and return the map. Each game's bullpen line is the sum of the relievers'
+    lines from the box score, which are every pitcher the team used after 
+    the starter.
+
+    team_bullpen['2021-07-19'] = {'game_H': 3.0, 'game_outs': 10, ...}
 
-    team_bullpen['2021-07-19'] = {'pregame_ERA': 3.48, ...}
+    The pregame ERA and WHIP are added afterwards, by 
+    stats_utils.calculate_bullpen_stats() for a whole season or by the 
+    aggregate state for new games.
     """
     print(f'{data_utils.BACKSPACE*6} {team_abbr} {data_utils.CHECK}', end='', flush=True)
-    game_page = SESSION.get(f'https://www.baseball-reference.com/teams/tgl.cgi?team={team_abbr}&t=p&year={year}').text
-    soup = BeautifulSoup(game_page, 'lxml')
-    remove_headers(soup)
-    season = soup.find('div', id='div_team_pitching_gamelogs').find_all('tr')[1:]
-
-    season_ER, season_BB, season_H, season_IP = (0, 0, 0, 0)
-    team_bullpen = {}
-    for game in season:
-        if data_utils.game_suspended(game):
-            continue
-        date = data_utils.get_stat_value(game, 'date_game')
+    if team_bullpen is None:
+        team_bullpen = {}
+    for date in season_games[team_abbr]:
         if date in team_bullpen:
-            date += ' (2)'
-        opp_abbr = data_utils.get_stat_value(game, 'opp_ID')
-
-        # game was suspended but baseball-reference mistakenly doesn't have it marked 
-        if date not in season_games[opp_abbr] or date not in season_games[team_abbr]:
-            continue
-        # game not listed as suspended on hitting log, but suspended on the game recap page
-        if 'opp_starter_id' not in season_games[opp_abbr][date] or 'opp_starter_id' not in season_games[team_abbr][date]:
             continue
-        # game page did not list a starting pitcher
-        if season_games[opp_abbr][date]['opp_starter_id'] == 'not_found':
+        opp_games = season_games[season_games[team_abbr][date]['opp']]
+        # box score was suspended, quarantined or hasn't been scraped
+        if date not in opp_games or 'opp_pitchers' not in opp_games[date]:
             continue
 
-        starter_id = season_games[opp_abbr][date]['opp_starter_id']
-        last_name = season_games[opp_abbr][date]['opp_starter'].split('.')[-1]
-        full_name = season_games[opp_abbr][date]['opp_starter_name']
-        # starting pitcher disagreement between game log and recap page
-        if not data_utils.starter_verified(last_name, full_name):
-            continue
-
-        starter_stats = pitcher_data[starter_id][date]
-        game_H = data_utils.get_stat_value(game, 'H') - starter_stats['H']
-        game_IP = data_utils.add_IP(data_utils.get_stat_value(game, 'IP'), -starter_stats['IP'])
-        game_BB = data_utils.get_stat_value(game, 'BB') - starter_stats['BB']
-        game_ER = data_utils.get_stat_value(game, 'ER') - starter_stats['ER']
+        game_H, game_outs, game_BB, game_ER = (0.0, 0, 0.0, 0.0)
+        for reliever in opp_games[date]['opp_pitchers'][1:]:
+            stats = pitcher_data[reliever][date]
+            game_H += stats['H']
+            game_outs += stats['outs']
+            game_BB += stats['BB']
+            game_ER += stats['ER']
 
         team_bullpen[date] = {
             'game_H': game_H,
-            'game_IP': game_IP,
+            'game_IP': data_utils.outs_to_IP(game_outs),
+            'game_outs': game_outs,
             'game_ER': game_ER,
             'game_BB': game_BB,
         }
-        if season_IP > 0:
-            team_bullpen[date]['pregame_ERA'] = data_utils.calculate_ERA(season_ER, season_IP)
-            team_bullpen[date]['pregame_WHIP'] = data_utils.calculate_WHIP(season_IP, season_BB, season_H)
-
-        season_H += game_H
-        season_IP = data_utils.add_IP(season_IP, game_IP)
-        season_BB += game_BB
-        season_ER += game_ER
-
     return team_bullpen
 
 
 def calculate_pitcher_stats(pitcher_data):
     """
-    Calculates WHIP and ERA for each starter as the season goes on, as well
-    as WHIP and ERA for each team's bullpen.
-    """
-    for pitcher in pitcher_data:
-        season_IP, season_ER, season_BB, season_H = (0, 0, 0, 0)
-        appearences = pitcher_data[pitcher]
-        for date in appearences:
-            game = appearences[date]
-            if season_IP > 0:
-                game['pregame_ERA'] = data_utils.calculate_ERA(season_ER, season_IP)
-                game['pregame_WHIP'] = data_utils.calculate_WHIP(season_IP, season_BB, season_H)
-            season_ER += game['ER']
-            season_BB += game['BB']
-            season_H += game['H']
-            season_IP = data_utils.add_IP(season_IP, game['IP'])
+    Calculates WHIP and ERA for each starter as the season goes on.
+    """
+    stats_utils.calculate_pitcher_stats(pitcher_data)
     print(data_utils.DONE)
 
 
+def calculate_pitching_form(season_games, pitcher_data, bullpen_data, since=None):
+    """
+    Calculates each starter's ERA and WHIP over their last few starts and 
+    the outs each team's bullpen recorded over the last few days, for the
+    games on or after since if it's given.
+    """
+    stats_utils.calculate_starter_form(season_games, pitcher_data, since=since)
+    stats_utils.calculate_bullpen_workload(bullpen_data, since=since)
+
+
 def calculate_offensive_stats(season_games):
     """
     Calculates offensive statistics (BA, SLG, OBP, OPS) for a team's:
@@ -189,292 +155,358 @@ def calculate_offensive_stats(season_games):
     - season splits for when a RHP starts vs when a LHP starts
     and and adds the statistics to the json map of game data.
     """
-    for team in season_games:
-        # initialize stats for a team's season splits - home/away, games against RHP starters vs LHP starters
-        home_H, home_AB, home_BB, home_SF, home_HBP, home_1B, home_2B, home_3B, home_HR = (0, 0, 0, 0, 0, 0, 0, 0, 0)
-        away_H, away_AB, away_BB, away_SF, away_HBP, away_1B, away_2B, away_3B, away_HR = (0, 0, 0, 0, 0, 0, 0, 0, 0)
-        left_H, left_AB, left_BB, left_SF, left_HBP, left_1B, left_2B, left_3B, left_HR = (0, 0, 0, 0, 0, 0, 0, 0, 0)
-        right_H, right_AB, right_BB, right_SF, right_HBP, right_1B, right_2B, right_3B, right_HR = (0, 0, 0, 0, 0, 0, 0, 0, 0)
-        dates = list(season_games[team])
-        first_game = season_games[team][dates[0]]
-        if first_game['home']:
-            home_H = first_game['H']
-            home_AB = first_game['AB']
-            home_BB = first_game['BB']
-            home_SF = first_game['SF']
-            home_HBP = first_game['HBP']
-            home_1B = first_game['H']-(first_game['2B']+first_game['3B']+first_game['HR'])
-            home_2B = first_game['2B']
-            home_3B = first_game['3B']
-            home_HR = first_game['HR']
-        else:
-            away_H = first_game['H']
-            away_AB = first_game['AB']
-            away_BB = first_game['BB']
-            away_SF = first_game['SF']
-            away_HBP = first_game['HBP']
-            away_1B = first_game['H']-(first_game['2B']+first_game['3B']+first_game['HR'])
-            away_2B = first_game['2B']
-            away_3B = first_game['3B']
-            away_HR = first_game['HR']
-
-        if first_game['opp_starter_righty']:
-            right_H = first_game['H']
-            right_AB = first_game['AB']
-            right_BB = first_game['BB']
-            right_SF = first_game['SF']
-            right_HBP = first_game['HBP']
-            right_1B = first_game['H']-(first_game['2B']+first_game['3B']+first_game['HR'])
-            right_2B = first_game['2B']
-            right_3B = first_game['3B']
-            right_HR = first_game['HR']
-        else:
-            left_H = first_game['H']
-            left_AB = first_game['AB']
-            left_BB = first_game['BB']
-            left_SF = first_game['SF']
-            left_HBP = first_game['HBP']
-            left_1B = first_game['H']-(first_game['2B']+first_game['3B']+first_game['HR'])
-            left_2B = first_game['2B']
-            left_3B = first_game['3B']
-            left_HR = first_game['HR']
-
-        # loop through all of the games, starting with the second game
-        for i in range(1, len(dates)):
-            date = dates[i]
-            game = season_games[team][date]
-            prev_game = season_games[team][dates[i-1]]
-
-            game['pregame_BA'] = prev_game['postgame_BA']
-            game['pregame_OBP'] = prev_game['postgame_OBP']
-            game['pregame_SLG'] = prev_game['postgame_SLG']
-            game['pregame_OPS'] = prev_game['postgame_OPS']
-
-            if home_AB > 0:
-                game['home_BA'] = data_utils.calculate_BA(home_AB, home_H)
-                game['home_OBP'] = data_utils.calculate_OBP(home_H, home_BB, home_HBP, home_AB, home_SF)
-                game['home_SLG'] = data_utils.calculate_SLG(home_1B, home_2B, home_3B, home_HR, home_AB)
-                game['home_OPS'] = data_utils.calculate_OPS(game['home_OBP'], game['home_SLG'])
-            if away_AB > 0:
-                game['away_BA'] = data_utils.calculate_BA(away_AB, away_H)
-                game['away_OBP'] = data_utils.calculate_OBP(away_H, away_BB, away_HBP, away_AB, away_SF)
-                game['away_SLG'] = data_utils.calculate_SLG(away_1B, away_2B, away_3B, away_HR, away_AB)
-                game['away_OPS'] = data_utils.calculate_OPS(game['away_OBP'], game['away_SLG'])
-            if right_AB > 0:
-                game['right_BA'] = data_utils.calculate_BA(right_AB, right_H)
-                game['right_OBP'] = data_utils.calculate_OBP(right_H, right_BB, right_HBP, right_AB, right_SF)
-                game['right_SLG'] = data_utils.calculate_SLG(right_1B, right_2B, right_3B, right_HR, right_AB)
-                game['right_OPS'] = data_utils.calculate_OPS(game['right_OBP'], game['right_SLG'])
-            if left_AB > 0:
-                game['left_BA'] = data_utils.calculate_BA(left_AB, left_H)
-                game['left_OBP'] = data_utils.calculate_OBP(left_H, left_BB, left_HBP, left_AB, left_SF)
-                game['left_SLG'] = data_utils.calculate_SLG(left_1B, left_2B, left_3B, left_HR, left_AB)
-                game['left_OPS'] = data_utils.calculate_OPS(game['left_OBP'], game['left_SLG'])
-
-            if game['home']:
-                home_H += game['H']
-                home_AB += game['AB']
-                home_BB += game['BB']
-                home_SF += game['SF']
-                home_HBP += game['HBP']
-                home_1B += game['H']-(game['2B']+game['3B']+game['HR'])
-                home_2B += game['2B']
-                home_3B += game['3B']
-                home_HR += game['HR']
-            else:              
-                away_H += game['H']
-                away_AB += game['AB']
-                away_BB += game['BB']
-                away_SF += game['SF']
-                away_HBP += game['HBP']
-                away_1B += game['H']-(game['2B']+game['3B']+game['HR'])
-                away_2B += game['2B']
-                away_3B += game['3B']
-                away_HR += game['HR']
-            if game['opp_starter_righty']:
-                right_H += game['H']
-                right_AB += game['AB']
-                right_BB += game['BB']
-                right_SF += game['SF']
-                right_HBP += game['HBP']
-                right_1B += game['H']-(game['2B']+game['3B']+game['HR'])
-                right_2B += game['2B']
-                right_3B += game['3B']
-                right_HR += game['HR']
-            else:
-                left_H += game['H']
-                left_AB += game['AB']
-                left_BB += game['BB']
-                left_SF += game['SF']
-                left_HBP += game['HBP']
-                left_1B += game['H']-(game['2B']+game['3B']+game['HR'])
-                left_2B += game['2B']
-                left_3B += game['3B']
-                left_HR += game['HR']
-
-            # collect stats from last n games
-            for n in [10, 15]:
-                recent_H, recent_AB, recent_BB, recent_SF, recent_HBP, recent_1B, recent_2B, recent_3B, recent_HR = 0, 0, 0, 0, 0, 0, 0, 0, 0
-                for j in range(1, n+1):
-                    if i-j < 0:
-                        break
-                    prev_date = dates[i-j]
-                    prev_game = season_games[team][prev_date]
-                    recent_H += prev_game['H']
-                    recent_AB += prev_game['AB']
-                    recent_BB += prev_game['BB']
-                    recent_SF += prev_game['SF']
-                    recent_HBP += prev_game['HBP']
-                    recent_1B += prev_game['H']-(prev_game['2B']+prev_game['3B']+prev_game['HR'])
-                    recent_2B += prev_game['2B']
-                    recent_3B += prev_game['3B']
-                    recent_HR += prev_game['HR']
-
-                game[f'{n}-day_BA'] = data_utils.calculate_BA(recent_AB, recent_H)
-                game[f'{n}-day_OBP'] = data_utils.calculate_OBP(recent_H, recent_BB, recent_HBP, recent_AB, recent_SF)
-                game[f'{n}-day_SLG'] = data_utils.calculate_SLG(recent_1B, recent_2B, recent_3B, recent_HR, recent_AB)
-                game[f'{n}-day-OPS'] = data_utils.calculate_OPS(game[f'{n}-day_OBP'], game[f'{n}-day_SLG'])
-
+    stats_utils.calculate_offensive_stats(season_games)
     print(data_utils.DONE)
 
 
-def get_season_pitching(year, season_games):
+def get_season_pitching(year, season_games, workers=WORKERS, season_pitching=None, since=None, 
+                        quarantine=None, resume_after=None, checkpoint_every=None):
     """
     Scrape all of the desired pitching data from the given year and load it into
     a dictionary containing all of the stats into a json file. Also add some 
     information about the game like temperature and time.
+
+    Box scores are fetched by `workers` threads, but are always processed in 
+    schedule order.
+
+    To extend stored data, pass the stored season_pitching and the earliest
+    date that may be missing games; box scores from before `since` and games
+    that were already scraped are skipped.
+
+    Box scores that can't be parsed are added to the quarantine list instead 
+    of stopping the scrape. With checkpoint_every set, a checkpoint is saved 
+    after every that many games, and resume_after skips the schedule up to 
+    and including the last game of a saved checkpoint.
     """
     schedule_page = SESSION.get(f'https://www.baseball-reference.com/leagues/majors/{year}-schedule.shtml').text
     soup = BeautifulSoup(schedule_page, 'lxml')
     schedule = soup.find_all('p', class_='game')
-    
-    season_pitching = {}
+
+    game_ids = []
     for game in schedule:
         game_id = game.select('a')[2].get('href')
         if data_utils.has_not_happened(game_id):
             break
-        game_page = SESSION.get('https://www.baseball-reference.com/' + game_id).text
-        soup = BeautifulSoup(game_page, 'lxml')
-        if data_utils.is_playoffs(soup):
-            break
-        if data_utils.was_suspended(soup):
+        if since is not None and data_utils.get_game_id_date(game_id) < since:
+            continue
+        game_ids.append(game_id)
+    if resume_after in game_ids:
+        game_ids = game_ids[game_ids.index(resume_after)+1:]
+    urls = ['https://www.baseball-reference.com/' + game_id for game_id in game_ids]
+    
+    if season_pitching is None:
+        season_pitching = {}
+    if quarantine is None:
+        quarantine = []
+    pages = request_utils.get_pages(SESSION, urls, workers)
+    for i, (game_id, game_page) in enumerate(zip(game_ids, pages)):
+        if checkpoint_every and i > 0 and i % checkpoint_every == 0:
+            data_utils.dump_checkpoint(year, {
+                'last_game_id': game_ids[i-1],
+                'season_games': season_games,
+                'season_pitching': season_pitching,
+                'quarantine': quarantine,
+            })
+
+        try:
+            box_score = data_utils.parse_box_score(game_page)
+            if box_score.playoffs:
+                break
+            if box_score.suspended:
+                continue
+            date, away_abbr, home_abbr = box_score.date, box_score.away, box_score.home
+            away_games, home_games = season_games[away_abbr], season_games[home_abbr]
+        except (KeyError, ValueError, IndexError, AttributeError, TypeError) as error:
+            quarantine.append({'game_id': game_id, 'error': repr(error)})
+            report(f'{game_id} quarantined ({repr(error)})')
             continue
 
-        date, away_abbr, home_abbr = data_utils.parse_title(soup.title.text)
-        if data_utils.is_second_game(soup):
-            date += ' (2)'
+        # not in the game logs yet
+        if date not in away_games or date not in home_games:
+            continue
+        # already scraped
+        if 'opp_pitchers' in away_games[date]:
+            continue
 
-        away_starter, home_starter = data_utils.get_starting_pitchers(soup)
+        away_starter, home_starter = box_score.away_starter, box_score.home_starter
         season_games[away_abbr][date]['opp_starter_name'] = home_starter[0]
         season_games[away_abbr][date]['opp_starter_id'] = home_starter[1]
         season_games[home_abbr][date]['opp_starter_name'] = away_starter[0]
         season_games[home_abbr][date]['opp_starter_id'] = away_starter[1]
 
         # add details/features that are found on this page (night, temp)
-        night_game = data_utils.get_night_game(soup)
-        temp = data_utils.get_temperature(soup)
-        season_games[home_abbr][date]['night_game'] = night_game
-        season_games[away_abbr][date]['night_game'] = night_game
-        season_games[home_abbr][date]['temp'] = temp
-        season_games[away_abbr][date]['temp'] = temp
-
-        team = away_abbr
-        opp = home_abbr
-        team_totals = 0
-        # find and add each pitcher's stats
-        for line in game_page.split('\n'):
-            if team_totals == 2:
-                break
-            if not data_utils.is_pitching_row(line):
-                continue
-            if data_utils.has_team_totals(line):
-                team = home_abbr
-                opp = away_abbr
-                team_totals += 1
-                continue
-            stats = parse_pitcher_stats(line)
-            add_pitcher_stats(stats, team, opp, date, season_pitching, season_games)
-        data_utils.print_same_line(f'{date} - {away_abbr} @ {home_abbr} {data_utils.CHECK}')
+        season_games[home_abbr][date]['night_game'] = box_score.night
+        season_games[away_abbr][date]['night_game'] = box_score.night
+        season_games[home_abbr][date]['temp'] = box_score.temp
+        season_games[away_abbr][date]['temp'] = box_score.temp
+
+        # add each pitcher's stats
+        for stats in box_score.away_pitchers:
+            add_pitcher_stats(stats, away_abbr, home_abbr, date, season_pitching, season_games)
+        for stats in box_score.home_pitchers:
+            add_pitcher_stats(stats, home_abbr, away_abbr, date, season_pitching, season_games)
+        report(f'{date} - {away_abbr} @ {home_abbr} {data_utils.CHECK} [{SESSION.stats}]')
 
     return season_pitching
 
 
-def get_season_offense(team_abbr, year):
+def get_season_offense(team_abbr, year, season_games=None):
     """
     Adds a team's desired boxscore values for each game in the specified season.
     Adds the desired stats from each row listed here: 
     https://www.baseball-reference.com/teams/tgl.cgi?team=BOS&t=b&year=2021'
+
+    When season_games already holds the team's stored games, only the games
+    played since are added to it.
     """
     season_page = SESSION.get(f'https://www.baseball-reference.com/teams/tgl.cgi?team={team_abbr}&t=b&year={year}').text
-    soup = BeautifulSoup(season_page, 'lxml')
-    remove_headers(soup)
-    table = soup.find(id='team_batting_gamelogs').find_all('tr')[1:]
+    table = data_utils.parse_gamelog_table(season_page, 'team_batting_gamelogs', ALL_STATS)
 
     count = 0
-    season_games = {}
-    for row in table:
-        if data_utils.game_suspended(row):
-            continue
-        box_score = {}
-        for stat in ALL_STATS:
-            box_score[stat] = data_utils.get_stat_value(row, stat)
-        add_yesterday_off(box_score, season_games)
-        date = box_score['date']
-        if date in season_games:
+    if season_games is None:
+        season_games = {}
+    game_keys = set()
+    played_days = {data_utils.game_key_day(data_utils.to_game_key(date)) for date in season_games}
+    for i in range(len(table['date'])):
+        date = table['date'][i]
+        if date in game_keys:
             date += ' (2)'
+        game_keys.add(date)
+        # already stored
+        if date in season_games:
+            continue
+        box_score = {stat: table[stat][i] for stat in ALL_STATS}
+        add_yesterday_off(box_score, played_days)
         season_games[date] = box_score
+        played_days.add(data_utils.game_key_day(data_utils.to_game_key(date)))
         count += 1
-    data_utils.print_same_line(f'{team_abbr} ({count} games) {data_utils.CHECK}')
+    report(f'{team_abbr} ({count} games) {data_utils.CHECK}')
 
     return season_games
 
 
-def get_data(years):
+def map_teams(function, teams, workers=WORKERS):
+    """
+    Call function(team_abbr) for every team on up to `workers` threads and
+    return a dict of the results, in the same order as the teams list.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(teams, executor.map(function, teams)))
+
+
+def get_data(years, workers=WORKERS, processes=PROCESSES, resume=False):
     """
     Collect and calculate the necessary data from every year in 
-    the years list.
+    the years list. With more than one process, seasons are scraped in 
+    parallel by separate worker processes.
     """
+    if processes > 1 and len(years) > 1:
+        get_data_parallel(years, workers, processes, resume)
+        return
     for year in years:
-        print(f'\n====================== {year} ======================')
+        get_season_data(year, workers, resume)
+
 
+def get_season_data(year, workers=WORKERS, resume=False):
+    """
+    Collect and calculate the necessary data for a single season and dump
+    it into the year's data folder. Progress through the box scores is 
+    checkpointed, and with resume the scrape picks up from the year's last 
+    checkpoint if there is one.
+    """
+    global SEASON_YEAR
+    SEASON_YEAR = year
+    print(f'\n====================== {year} ======================')
+
+    checkpoint = data_utils.load_checkpoint(year) if resume else None
+    if checkpoint is None:
         # get hitting data
-        season_games = {}
         print(f'\nScraping{Style.BRIGHT} [hitting] {Style.RESET_ALL}data:')
         teams = data_utils.get_team_abbreviations(year)
-        for team_abbr in teams:
-            season_games[team_abbr] = get_season_offense(team_abbr, year)
+        season_games = map_teams(lambda team_abbr: get_season_offense(team_abbr, year), teams, workers)
         print('Calculating offensive stats...', flush=True, end=' ')
         calculate_offensive_stats(season_games)
+        checkpoint = {'last_game_id': None, 'season_pitching': {}, 'quarantine': []}
+    else:
+        print(f'\nResuming from checkpoint after {checkpoint["last_game_id"]}')
+        season_games = checkpoint['season_games']
+        data_utils.add_outs(checkpoint['season_pitching'])
+        teams = list(season_games)
+
+    # get pitching data
+    print(f'\nScraping{Style.BRIGHT} [pitching] {Style.RESET_ALL}data:')
+    quarantine = checkpoint['quarantine']
+    pitcher_data = get_season_pitching(year, season_games, workers, checkpoint['season_pitching'], quarantine=quarantine,
+                                       resume_after=checkpoint['last_game_id'], checkpoint_every=CHECKPOINT_EVERY)
+    print(f'Gathering each team\'s bullpen stats...', end='      ', flush=True)
+    bullpen_data = {}
+    for team_abbr in teams:
+        bullpen_data[team_abbr] = get_bullpen_stats(season_games, pitcher_data, team_abbr)
+    print(data_utils.BACKSPACE*5+data_utils.DONE)
+    print('Calculating pitching stats...', flush=True, end=' ')
+    stats_utils.calculate_bullpen_stats(bullpen_data)
+    calculate_pitching_form(season_games, pitcher_data, bullpen_data)
+    calculate_pitcher_stats(pitcher_data)
+    stats_utils.calculate_league_adjusted(season_games, pitcher_data, bullpen_data)
+
+    dump_season(year, season_games, pitcher_data, bullpen_data, quarantine)
+    state_utils.dump_state(year, state_utils.build_state(season_games, pitcher_data, bullpen_data))
+    data_utils.remove_checkpoint(year)
+    SESSION.cache.save_index()
+    report(f'Done {data_utils.CHECK}' + (f' ({len(quarantine)} quarantined)' if quarantine else ''))
+
+
+def init_season_worker(progress_queue, request_budget, offline):
+    """
+    Set up a worker process for get_data_parallel. The worker's requests 
+    share one rate limit with every other worker, and its progress is sent
+    back to the parent instead of being printed.
+    """
+    global PROGRESS_QUEUE
+    PROGRESS_QUEUE = progress_queue
+    SESSION.limiter = request_budget
+    SESSION.offline = offline
+    sys.stdout = open(os.devnull, 'w')
+
+
+def get_data_parallel(years, workers, processes, resume=False):
+    """
+    Scrape each season in its own worker process, printing the latest 
+    progress of every season on its own line.
+    """
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    request_budget = request_utils.SharedRateLimiter(SESSION.limiter.rate)
+    progress = {str(year): 'Waiting...' for year in years}
+    data_utils.print_progress(progress, first=True)
+
+    initargs = (progress_queue, request_budget, SESSION.offline)
+    with ProcessPoolExecutor(processes, initializer=init_season_worker, initargs=initargs) as executor:
+        seasons = [executor.submit(get_season_data, year, workers, resume) for year in years]
+        while not all(season.done() for season in seasons):
+            try:
+                year, message = progress_queue.get(timeout=.5)
+                progress[str(year)] = message
+                while not progress_queue.empty():
+                    year, message = progress_queue.get()
+                    progress[str(year)] = message
+            except queue.Empty:
+                pass
+            data_utils.print_progress(progress)
+        # raise any errors from the workers
+        for season in seasons:
+            season.result()
+    while not progress_queue.empty():
+        year, message = progress_queue.get()
+        progress[str(year)] = message
+    data_utils.print_progress(progress)
+
+
+def update_data(year, workers=WORKERS):
+    """
+    Add the games played since the last scrape to the stored data for the 
+    given year. Only box scores from on or after the date of the least 
+    recently updated team's last game are fetched, and the new games' stats
+    come from the season's aggregate state instead of being recalculated.
+    """
+    if not os.path.isfile(f'data/{year}/game-data.json'):
+        get_data([year], workers)
+        return
+
+    season_games = data_utils.load_data(year, 'game-data.json')
+    pitcher_data = data_utils.load_data(year, 'pitcher-data.json')
+    bullpen_data = data_utils.load_data(year, 'team-bullpen-data.json')
+    data_utils.add_outs(pitcher_data, bullpen_data)
+    state = state_utils.load_state(year)
+    if state is None or not state_utils.is_current(state, season_games, pitcher_data, bullpen_data):
+        state = state_utils.build_state(season_games, pitcher_data, bullpen_data)
+    last_dates = [list(games)[-1].split()[0] for games in season_games.values() if games]
+    since = min(last_dates) if len(last_dates) == len(season_games) else None
+
+    # get hitting data
+    print(f'\nScraping{Style.BRIGHT} [hitting] {Style.RESET_ALL}data:')
+    teams = data_utils.get_team_abbreviations(year)
+    season_games = map_teams(lambda team_abbr: get_season_offense(team_abbr, year, season_games.get(team_abbr)), teams, workers)
+
+    # get pitching data
+    print(f'\nScraping{Style.BRIGHT} [pitching] {Style.RESET_ALL}data:')
+    quarantine = []
+    pitcher_data = get_season_pitching(year, season_games, workers, pitcher_data, since, quarantine)
+    print(f'Gathering each team\'s bullpen stats...', end='      ', flush=True)
+    for team_abbr in teams:
+        bullpen_data[team_abbr] = get_bullpen_stats(season_games, pitcher_data, team_abbr, bullpen_data.get(team_abbr))
+    print(data_utils.BACKSPACE*5+data_utils.DONE)
+    print('Calculating stats for the new games...', flush=True, end=' ')
+    if not state_utils.update_state(state, season_games, pitcher_data, bullpen_data):
+        # a box score came in after later games were folded into the state
+        recalculate_season(season_games, pitcher_data, bullpen_data)
+        state = state_utils.build_state(season_games, pitcher_data, bullpen_data)
+        since = None
+    calculate_pitching_form(season_games, pitcher_data, bullpen_data, since)
+    stats_utils.calculate_league_adjusted(season_games, pitcher_data, bullpen_data, since)
+    print(data_utils.DONE)
+
+    # keep the box scores quarantined by earlier updates, with the latest error of each
+    quarantined = {entry['game_id']: entry for entry in data_utils.load_quarantine(year) + quarantine}
+    dump_season(year, season_games, pitcher_data, bullpen_data, list(quarantined.values()))
+    state_utils.dump_state(year, state)
+
+
+def recalculate_season(season_games, pitcher_data, bullpen_data):
+    """
+    Put every team's games, pitcher's appearances and bullpen's games back
+    in order of game key and recalculate their pregame stats from scratch.
+    """
+    for season_data in [season_games, pitcher_data, bullpen_data]:
+        for name, records in season_data.items():
+            season_data[name] = dict(sorted(records.items(), key=lambda item: data_utils.to_game_key(item[0])))
+    stats_utils.calculate_offensive_stats(season_games)
+    stats_utils.calculate_pitcher_stats(pitcher_data)
+    stats_utils.calculate_bullpen_stats(bullpen_data)
 
-        # get pitching data
-        print(f'\nScraping{Style.BRIGHT} [pitching] {Style.RESET_ALL}data:')
-        pitcher_data = get_season_pitching(year, season_games)
-        print(f'Gathering each team\'s bullpen stats...', end='      ', flush=True)
-        bullpen_data = {}
-        for team_abbr in teams:
-            bullpen_data[team_abbr] = get_bullpen_stats(season_games, pitcher_data, team_abbr, year)
-        print(data_utils.BACKSPACE*5+data_utils.DONE)
-        print('Calculating pitching stats...', flush=True, end=' ')
-        calculate_pitcher_stats(pitcher_data)
-
-         # create folder and dump the data
-        if not os.path.isdir(f'data/{year}'):
-            os.mkdir(f'data/{year}')
-        data_utils.dump_data(year, 'team-bullpen-data.json', bullpen_data)
-        data_utils.dump_data(year, 'pitcher-data.json', pitcher_data)
-        data_utils.dump_data(year, 'game-data.json', season_games)
+
+def dump_season(year, season_games, pitcher_data, bullpen_data, quarantine=None):
+    """
+    Create the year's data folder if needed and dump the season's data,
+    along with the list of quarantined box scores if there are any.
+    """
+    if not os.path.isdir(f'data/{year}'):
+        os.mkdir(f'data/{year}')
+    if quarantine:
+        data_utils.dump_data(year, 'quarantine.json', quarantine)
+    data_utils.dump_data(year, 'team-bullpen-data.json', bullpen_data)
+    data_utils.dump_data(year, 'pitcher-data.json', pitcher_data)
+    data_utils.dump_data(year, 'game-data.json', season_games)
+    if storage_utils.has_columnar(year):
+        storage_utils.dump_columnar(year, season_games, pitcher_data, bullpen_data)
+    if data_utils.DATABASE.exists():
+        data_utils.DATABASE.add_season(year, season_games, pitcher_data, bullpen_data)
 
 
 def main():
     """
     Run the functions to scrape the data. 
     """
-    allowed_args = ['-update', '-u', '-year']
+    allowed_args = ['-update', '-u', '-year', '-workers', '-processes', '-rate', '-offline', '-resume', '-migrate', '-refresh', '-convert', '-database']
     args = sys.argv[1:]
     for arg in args:
         if '-' in arg and arg not in allowed_args:
             print(f'Invalid argument: {arg}')
             return
+
+    workers = WORKERS
+    if '-workers' in args:
+        workers = int(args[args.index('-workers')+1])
+        SESSION.set_pool_size(max(workers, request_utils.POOL_SIZE))
+    processes = PROCESSES
+    if '-processes' in args:
+        processes = int(args[args.index('-processes')+1])
+    if '-rate' in args:
+        SESSION.set_rate(float(args[args.index('-rate')+1]))
+    if '-offline' in args:
+        SESSION.offline = True
+    if '-refresh' in args:
+        data_utils.METADATA.clear()
     
     years = [str(year) for year in range(model.START_YEAR, model.END_YEAR+1) if year != 2020]
     update = False
@@ -484,18 +516,39 @@ def main():
     elif '-year' in args:
         years = [args[args.index('-year')+1]]
 
+    if '-migrate' in args:
+        for year in years:
+            if os.path.isfile(f'data/{year}/pitcher-data.json'):
+                data_utils.migrate_outs(year)
+        print('\nAdded outs to the stored pitching data.\n')
+        return
+
+    if '-convert' in args:
+        for year in years:
+            if os.path.isfile(f'data/{year}/game-data.json'):
+                storage_utils.convert_json(year)
+        print('\nWrote the stored data to columnar files.\n')
+        return
+
+    if '-database' in args:
+        for year in years:
+            if os.path.isfile(f'data/{year}/game-data.json'):
+                data_utils.DATABASE.add_season(year, *[storage_utils.load_season(year, entity) for entity in storage_utils.ENTITIES])
+        print(f'\nWrote the stored data to {data_utils.DATABASE_FILE}.\n')
+        return
+
     if update:
         yesterday = data_utils.get_day_before(TODAY)
         latest = data_utils.format_date_long(yesterday)
         print(f'\nPulling {years[0]} data through {Style.BRIGHT+latest+Style.RESET_ALL}...')
-        get_data(years)
+        update_data(years[0], workers)
         print(f'\nData through {latest} {Fore.GREEN+Style.BRIGHT}succesfully updated.{Style.RESET_ALL}\n')
         return
 
     time_period = Style.BRIGHT + (str(years[0]) if len(years) == 1 else f'{years[0]}-{years[-1]}') + Style.RESET_ALL
     run = input(f'\nScrape MLB game data from {time_period}? This will take some time. (y/n) ')
     if run.lower().strip() == 'y':  
-        get_data(years)
+        get_data(years, workers, processes, '-resume' in args)
         print(f'\nData from {time_period}{Fore.GREEN+Style.BRIGHT} succesfully scraped.{Style.RESET_ALL}\n')
 
 
@@ -1,7 +1,7 @@
 
 import pandas as pd
 import datetime
-import data_utils
+import data_utils, storage_utils
 from pybaseball import team_game_logs
 import sys
 
@@ -39,15 +39,19 @@ def get_date(row, year):
 
 def main():
     """
+    Merge the opening and closing over/unders from the odds sheets into the
+    stored games. Each year's games are loaded on their own, since the
+    season's game file is rewritten with the odds anyway, and the database
+    and columnar files are kept in sync when they exist.
     """
     start_year = 2010
     end_year = 2022
-    years = [str(year) for year in range(start_year, end_year+1) if year != 2020]
-    game_data, pitcher_data, bullpen_data = data_utils.get_data_dicts(start_year, end_year)
+    years = storage_utils.get_years(start_year, end_year)
     if 'l' in sys.argv or '-latest' in sys.argv:
-        years = [datetime.date.today().year]
+        years = [str(datetime.date.today().year)]
 
     for year in years:
+        game_data = storage_utils.load_season(year, 'games')
         odds = pd.read_excel(f'vegas_odds/{year}.xlsx')
         df = pd.DataFrame(odds)
         games = set()
@@ -63,29 +67,34 @@ def main():
             games.add(game_id)
 
             # mostly playoff games
-            if date not in game_data[year][team]:
+            if date not in game_data[team]:
                 continue
 
             open_over_under = row['Open OU']
             open_ou_odds = row['Open OU Odds']
             close_over_under = row['Close OU']
             runs_scored = row['Final']
-            game_runs = game_data[year][team][date]['R']
+            game_runs = game_data[team][date]['R']
             if game_runs != runs_scored:
                 # sometimes the double headers are not in chronological order
-                if date + ' (2)' in game_data[year][team]:
+                if date + ' (2)' in game_data[team]:
                     date += ' (2)'
                 elif ' (2)' in date:
                     date = date[:date.find('(')].strip()
-                game_runs = game_data[year][team][date]['R']
+                game_runs = game_data[team][date]['R']
                 if runs_scored != game_runs:
                     print('MIXUP:', team, opp_team, date, f'-- [{team}]', 'me:', game_runs, 'vs odds sheet:', runs_scored)
             
-            game_data[year][team][date]['open_over_under'] = open_over_under
-            game_data[year][team][date]['close_over_under'] = close_over_under
-            game_data[year][team][date]['open_ou_odds'] = open_ou_odds
+            game_data[team][date]['open_over_under'] = open_over_under
+            game_data[team][date]['close_over_under'] = close_over_under
+            game_data[team][date]['open_ou_odds'] = open_ou_odds
 
-        data_utils.dump_data(year, 'game-data.json', game_data[year])
+        data_utils.dump_data(year, 'game-data.json', game_data)
+        if storage_utils.has_columnar(year):
+            storage_utils.dump_columnar(year, game_data, storage_utils.load_season(year, 'pitchers'),
+                                        storage_utils.load_season(year, 'bullpens'))
+        if data_utils.DATABASE.exists():
+            data_utils.DATABASE.add_games(year, game_data)
 
 
 if __name__ == '__main__':
@@ -11,14 +11,20 @@ from colorama import Fore, Style
 import pickle
 import sys
 import datetime
-import data_utils, model_utils
+import data_utils, model_utils, storage_utils, cache_utils
 
 
 MODEL_FILE = 'my_model.sav'
 START_YEAR = 2010
 END_YEAR = 2022
-GAME_DATA, PITCHER_DATA, BULLPEN_DATA = data_utils.get_data_dicts(START_YEAR, END_YEAR)
+DATA = storage_utils.SeasonStore(START_YEAR, END_YEAR, compact=True)
+GAME_DATA, PITCHER_DATA, BULLPEN_DATA = DATA.games, DATA.pitchers, DATA.bullpens
+GAME_INDEX = DATA.index
+# the database is only read if it had been written when the model was loaded
+DATABASE = data_utils.DATABASE if data_utils.DATABASE.exists() else None
 RUN_MAX = 9
+SAMPLE_CACHE = cache_utils.ArrayCache()
+SAMPLE_ROW = [('year', 'U4'), ('team', 'U3'), ('key', 'i8')]
 FEATURE_LIST = [
     'temp',
     'has_DH',
@@ -45,7 +51,7 @@ FEATURE_LIST = [
     'Sunday'
 ]
 
-def make_game_sample(game, year, team, date):
+def make_game_sample(game, year, team, key):
     """
     Create and return an array of feature values. Values are added
     in the same order as listed in the FEATURE_LIST list. 
@@ -68,16 +74,18 @@ def make_game_sample(game, year, team, date):
     sample.append(game[f'{throw}_SLG'])
     sample.append(game[f'{loc}_BA'])
     sample.append(game[f'{loc}_SLG'])
-    sample.append(data_utils.get_pitcher_ERA(PITCHER_DATA, year, game['opp_starter_id'], date))
-    sample.append(data_utils.get_pitcher_WHIP(PITCHER_DATA, year, game['opp_starter_id'], date))
-    sample.append(data_utils.get_bullpen_ERA(BULLPEN_DATA, year, game['opp'], date))
-    sample.append(data_utils.get_bullpen_WHIP(BULLPEN_DATA, year, game['opp'], date))
+    opp_starter = GAME_INDEX.get_appearance(year, game['opp_starter_id'], key)
+    opp_bullpen = GAME_INDEX.get_bullpen(year, game['opp'], key)
+    sample.append(opp_starter['pregame_ERA'])
+    sample.append(opp_starter['pregame_WHIP'])
+    sample.append(opp_bullpen['pregame_ERA'])
+    sample.append(opp_bullpen['pregame_WHIP'])
     sample.append(game['open_over_under'])
-    sample.extend(data_utils.get_weekdays(date))
+    sample.extend(data_utils.get_weekdays(key))
     return np.array(sample)
 
 
-def is_incomplete_sample(date, game):
+def is_incomplete_sample(key, game):
     """
     Return true if the game contains all of the necessary info
     for a full sample. 
@@ -98,57 +106,67 @@ def is_incomplete_sample(date, game):
         return True
     if not game['opp_starter_righty'] and 'left_BA' not in game:
         return True
-    year = date.split('-')[0]
-    opp_pitcher_id = game['opp_starter_id'] 
-    if opp_pitcher_id not in PITCHER_DATA[year]:
-        return True
-    if 'pregame_ERA' not in PITCHER_DATA[year][opp_pitcher_id][date]:
+    year = data_utils.game_key_year(key)
+    opp_starter = GAME_INDEX.get_appearance(year, game['opp_starter_id'], key)
+    if opp_starter is None or 'pregame_ERA' not in opp_starter:
         return True
-    opp = game['opp']
-    if date not in BULLPEN_DATA[year][opp]:
-        return True
-    if 'pregame_ERA' not in BULLPEN_DATA[year][opp][date]:
+    opp_bullpen = GAME_INDEX.get_bullpen(year, game['opp'], key)
+    if opp_bullpen is None or 'pregame_ERA' not in opp_bullpen:
         return True
     return False
 
 
-def get_samples(test_years=[]):
+def build_feature_matrix():
     """
-    Parse the game data and form data samples. Return 2d array of samples
-    and a 1d array of targets.
+    Parse the game data and return the feature matrix of every complete
+    sample, its targets, and the (year, team, key) of each row.
     """
-    incomplete = 0
     samples = []
     targets = []
-    train_samples = []
-    train_targets = []
-    test_samples = []
-    test_targets = []
+    rows = []
     for year in GAME_DATA:
         for team in GAME_DATA[year]:
-            for date in list(GAME_DATA[year][team])[1:]:
-                game = GAME_DATA[year][team][date]
-                team_runs = min(game['R'], RUN_MAX*9)
-                if is_incomplete_sample(date, game):
-                    incomplete += 1
+            for key, game in GAME_INDEX.get_team_games(year, team)[1:]:
+                if is_incomplete_sample(key, game):
                     continue
-                sample = make_game_sample(game, year, team, date)
-                samples.append(sample)
-                targets.append(team_runs)
-                if year not in test_years:
-                    train_samples.append(sample)
-                    train_targets.append(team_runs)
-                else:
-                    test_samples.append(sample)
-                    test_targets.append(team_runs)
+                samples.append(make_game_sample(game, year, team, key))
+                targets.append(min(game['R'], RUN_MAX*9))
+                rows.append((year, team, key))
+    return {
+        'features': np.array(samples, dtype=np.float32).reshape(len(samples), len(FEATURE_LIST)),
+        'targets': np.array(targets, dtype=np.int32),
+        'rows': np.array(rows, dtype=SAMPLE_ROW),
+    }
+
+
+def get_feature_matrix():
+    """
+    Return the memory-mapped feature matrix, targets and row index of every
+    sample. They're rebuilt and cached when FEATURE_LIST, RUN_MAX or any
+    data file has changed since they were last built.
+    """
+    fingerprint = cache_utils.fingerprint([FEATURE_LIST, RUN_MAX, DATA.years], storage_utils.get_data_files(DATA.years))
+    arrays = SAMPLE_CACHE.load('samples', fingerprint)
+    if arrays is None:
+        arrays = SAMPLE_CACHE.store('samples', fingerprint, build_feature_matrix())
+    return arrays['features'], arrays['targets'], arrays['rows']
+
 
-    df = pd.DataFrame(samples, columns=FEATURE_LIST)
+def to_sample_frame(features, targets):
+    df = pd.DataFrame(features, columns=FEATURE_LIST)
     df['runs_scored'] = targets
-    train_df = pd.DataFrame(train_samples, columns=FEATURE_LIST)
-    train_df['runs_scored'] = train_targets
-    test_df = pd.DataFrame(test_samples, columns=FEATURE_LIST)
-    test_df['runs_scored'] = test_targets
-    return df, train_df, test_df
+    return df
+
+
+def get_samples(test_years=[]):
+    """
+    Return DataFrames of all the samples, the samples outside the test
+    years and the samples in them, each with a runs_scored target column.
+    """
+    features, targets, rows = get_feature_matrix()
+    test = np.isin(rows['year'], [str(year) for year in test_years])
+    return (to_sample_frame(features, targets), to_sample_frame(features[~test], targets[~test]),
+            to_sample_frame(features[test], targets[test]))
 
 
 def compare_to_vegas(rf, test_years=[], nearest_half=True):
@@ -165,20 +183,22 @@ def compare_to_vegas(rf, test_years=[], nearest_half=True):
     games_bet = 0
     for year in test_years:
         for team in GAME_DATA[year]:
-            for date in GAME_DATA[year][team]:
-                game1 = GAME_DATA[year][team][date]
+            for key, game1 in GAME_INDEX.get_team_games(year, team):
                 opp = game1['opp']
-                game2 = GAME_DATA[year][opp][date]
+                game2 = GAME_INDEX.get_game(year, opp, key)
+                # the opponent's side of the game wasn't stored
+                if game2 is None:
+                    continue
                 home_team = team if game1['home'] else opp
                 away_team = opp if home_team == team else team
-                game_id = home_team + away_team + date
+                game_id = (home_team, away_team, key)
                 # don't predict the same game twice
                 if game_id in games:
                     continue
-                if is_incomplete_sample(date, game1) or is_incomplete_sample(date, game2):
+                if is_incomplete_sample(key, game1) or is_incomplete_sample(key, game2):
                     continue
-                sample1 = make_game_sample(game1, year, team, date).reshape(1, len(FEATURE_LIST))
-                sample2 = make_game_sample(game2, year, game1['opp'], date).reshape(1, len(FEATURE_LIST))
+                sample1 = make_game_sample(game1, year, team, key).reshape(1, len(FEATURE_LIST))
+                sample2 = make_game_sample(game2, year, game1['opp'], key).reshape(1, len(FEATURE_LIST))
 
                 prediction1 = float(rf.predict(sample1)[0])
                 prediction2 = float(rf.predict(sample2)[0])
@@ -292,7 +312,12 @@ def test_each_year():
 
 def get_most_recent_game(team):
     """
+    Return a team's last stored game, from the database if there is one.
     """
+    if DATABASE is not None:
+        most_recent = DATABASE.get_most_recent_game(team)
+        if most_recent is not None:
+            return most_recent[1]
     year = list(GAME_DATA)[-1]
     last_date = list(GAME_DATA[year][team])[-1]
     return GAME_DATA[year][team][last_date]
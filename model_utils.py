@@ -79,26 +79,26 @@ def get_pitcher_ERA(pitcher_data, year, id, date):
     """
     Return a pitcher's pregame ERA.
     """
-    return pitcher_data[year][id][date]['pregame_ERA']
+    return data_utils.get_pitcher_ERA(pitcher_data, year, id, date)
 
 
 def get_pitcher_WHIP(pitcher_data, year, id, date):
     """
     Return a pitcher's pregame WHIP.
     """
-    return pitcher_data[year][id][date]['pregame_WHIP']
+    return data_utils.get_pitcher_WHIP(pitcher_data, year, id, date)
 
 
 def get_bullpen_ERA(bullpen_data, year, team_abbr, date):
     """
     Return a team's bullpen pregame ERA.
     """
-    return bullpen_data[year][team_abbr][date]['pregame_ERA']
+    return data_utils.get_bullpen_ERA(bullpen_data, year, team_abbr, date)
 
 
 def get_bullpen_WHIP(bullpen_data, year, team_abbr, date):
     """
     Return a team's bullpen pregame WHIP.
     """
-    return bullpen_data[year][team_abbr][date]['pregame_WHIP']
+    return data_utils.get_bullpen_WHIP(bullpen_data, year, team_abbr, date)
 
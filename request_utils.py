@@ -0,0 +1,256 @@
+import requests
+import threading
+import time
+import random
+import collections
+import itertools
+import multiprocessing
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 2
+MAX_BACKOFF = 120
+POOL_SIZE = 10
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    """
+    Per-host token bucket. Each host gets `rate` tokens per second, up to
+    `burst` saved tokens, and every request spends one. When a host starts
+    throttling, its next request is held back by the backoff delay and its
+    rate is halved, then it climbs back toward `rate` a little with every
+    successful request. Safe to share between threads.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def set_rate(self, rate):
+        """
+        Change the maximum number of requests per second for each host.
+        """
+        with self.lock:
+            self.rate = rate
+            self.hosts = {}
+
+    def host_state(self, url):
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = {'tokens': self.burst, 'updated': time.monotonic(), 'rate': self.rate}
+        return self.hosts[host]
+
+    def refill(self, state):
+        """
+        Add the tokens a host earned since its state was last updated.
+        """
+        now = time.monotonic()
+        state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated'])*state['rate'])
+        state['updated'] = now
+
+    def wait(self, url):
+        """
+        Block until a request to the url's host is allowed.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            state = self.host_state(url)
+            self.refill(state)
+            # take the token now, even if it means going into debt
+            state['tokens'] -= 1
+            delay = -state['tokens']/state['rate'] if state['tokens'] < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, url, delay):
+        """
+        Slow down requests to a host that is throttling us, and hold back
+        its next request for `delay` seconds by going into token debt.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            state = self.host_state(url)
+            self.refill(state)
+            state['rate'] = max(self.rate/64, state['rate']/2)
+            # the next request takes the token that's earned `delay` seconds from now
+            state['tokens'] = min(state['tokens'], 1 - delay*state['rate'])
+
+    def succeeded(self, url):
+        """
+        Speed requests to the host back up toward the maximum rate.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            state = self.host_state(url)
+            state['rate'] = min(self.rate, state['rate'] + self.rate/20)
+
+
+class SharedRateLimiter:
+    """
+    A rate limiter whose budget of `rate` requests per second is shared by
+    every process it is handed to, so parallel workers together stay under
+    the limit.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_slot = multiprocessing.Value('d', 0.0)
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def wait(self, url):
+        """
+        Block until the shared budget allows another request.
+        """
+        if not self.rate:
+            return
+        with self.next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + 1/self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def throttled(self, url, delay):
+        """
+        Hold back every process, not just the one that got throttled.
+        """
+        with self.next_slot.get_lock():
+            self.next_slot.value = max(self.next_slot.value, time.time() + delay)
+
+    def succeeded(self, url):
+        pass
+
+
+class RequestStats:
+    """
+    Live counters for a session: requests sent, retries and bytes received.
+
+    str(stats) --> '4.8 req/s, 1.2% retries, 35.1 MB'
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+
+    def add_request(self, num_bytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes += num_bytes
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def requests_per_second(self):
+        return self.requests / max(time.monotonic() - self.started, 1e-9)
+
+    def retry_rate(self):
+        return self.retries / self.requests if self.requests else 0.0
+
+    def __str__(self):
+        return f'{self.requests_per_second():.1f} req/s, {self.retry_rate()*100:.1f}% retries, {self.bytes/1e6:.1f} MB'
+
+
+def get_backoff(attempt, response=None):
+    """
+    Return how many seconds to wait before retry number `attempt`. Uses the
+    server's Retry-After header when it gives one, otherwise exponential
+    backoff with jitter.
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(MAX_BACKOFF, int(retry_after))
+    delay = min(MAX_BACKOFF, BACKOFF_BASE * 2**attempt)
+    return delay * random.uniform(.5, 1.5)
+
+
+class RateLimitedSession(requests.Session):
+    """
+    A requests session that schedules every request through a per-host
+    token bucket and retries connection errors, timeouts, throttling (429)
+    and server errors with backoff. Live counters are kept in `stats`.
+    """
+    def __init__(self, rate=None, timeout=TIMEOUT, max_retries=MAX_RETRIES, pool_size=POOL_SIZE):
+        super().__init__()
+        self.limiter = TokenBucket(rate)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = RequestStats()
+        self.set_pool_size(pool_size)
+
+    def set_rate(self, rate):
+        """
+        Change the maximum number of requests per second for each host.
+        """
+        self.limiter.set_rate(rate)
+
+    def set_pool_size(self, pool_size):
+        """
+        Keep up to pool_size connections open to each host, which should be at
+        least the number of threads sharing the session.
+        """
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.wait(url)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self.stats.add_retry()
+                time.sleep(get_backoff(attempt))
+                continue
+
+            self.stats.add_request(len(response.content))
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                delay = get_backoff(attempt, response)
+                self.limiter.throttled(url, delay)
+                self.stats.add_retry()
+                time.sleep(delay)
+                continue
+            self.limiter.succeeded(url)
+            return response
+
+
+def get_pages(session, urls, workers=1):
+    """
+    Yield the text of each page in the same order as the urls. With more
+    than one worker, up to `workers` pages are fetched concurrently while
+    the caller processes earlier pages.
+    """
+    if workers <= 1:
+        for url in urls:
+            yield session.get(url).text
+        return
+
+    urls = iter(urls)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for url in itertools.islice(urls, workers*2):
+            pending.append(executor.submit(session.get, url))
+        while pending:
+            page = pending.popleft().result().text
+            for url in itertools.islice(urls, 1):
+                pending.append(executor.submit(session.get, url))
+            yield page
+    finally:
+        # stop fetching if the caller quits early (ex: playoffs reached)
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,263 @@
+import os
+import json
+import itertools
+import collections
+import data_utils, stats_utils
+
+
+STATE_FILE = 'aggregate-state.json'
+# saved states of another version are rebuilt from the stored data
+STATE_VERSION = 2
+BATTING_COUNTS = stats_utils.BATTING_COUNTS
+PITCHING_TOTALS = ['outs', 'ER', 'BB', 'H']
+
+
+# The aggregate state of a season holds everything needed to calculate the
+# pregame stats of the next game without looking at earlier games:
+#
+# state['teams']['BOS'] = {
+#     'games': 120,                       # games folded into the state
+#     'last': 8084657,                    # game key of the last game folded in
+#     'splits': {'home': [...], ...},     # season batting counts for each split
+#     'windows': {'10': [...], ...},      # batting counts over the last n games
+#     'ewma': {'5': [...], ...},          # exponentially weighted batting counts
+#     'recent': [[...], ...],             # ring buffer of the last games' counts
+#     'postgame': [.251, .318, .402, .72] # season line after the last game
+# }
+# state['pitchers']['verlaju01'] = {'appearances': 20, 'last': 8084641, 'totals': [outs, ER, BB, H]}
+# state['bullpens']['BOS'] = {'games': 120, 'last': 8084657, 'totals': [outs, ER, BB, H]}
+#
+# Batting counts are in the order of BATTING_COUNTS. Records are folded in
+# order of game key.
+
+
+def new_state():
+    """
+    Return an empty aggregate state for the configured rolling windows and
+    half-lives.
+    """
+    return {'version': STATE_VERSION, 'windows': list(stats_utils.ROLLING_WINDOWS),
+            'half_lives': list(stats_utils.EWMA_HALF_LIVES), 'teams': {}, 'pitchers': {}, 'bullpens': {}}
+
+
+def load_state(year):
+    """
+    Return the year's saved aggregate state, or None if there isn't one or
+    it was saved by another version or with other rolling windows or
+    half-lives.
+    """
+    if not os.path.isfile(f'data/{year}/{STATE_FILE}'):
+        return None
+    state = data_utils.load_data(year, STATE_FILE)
+    if state.get('version') != STATE_VERSION:
+        return None
+    if state['windows'] != stats_utils.ROLLING_WINDOWS or state['half_lives'] != stats_utils.EWMA_HALF_LIVES:
+        return None
+    return state
+
+
+def dump_state(year, state):
+    """
+    Save the year's aggregate state, replacing the old file in one step.
+    """
+    with open(f'data/{year}/{STATE_FILE}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'data/{year}/{STATE_FILE}.tmp', f'data/{year}/{STATE_FILE}')
+
+
+def get_batting_counts(game):
+    """
+    Return a game's batting counts as a list in the order of BATTING_COUNTS.
+    """
+    singles = game['H'] - (game['2B'] + game['3B'] + game['HR'])
+    return [singles if stat == '1B' else game[stat] for stat in BATTING_COUNTS]
+
+
+def get_batting_line(counts):
+    """
+    Return [BA, OBP, SLG, OPS] from batting counts, or None with no at bats.
+    """
+    H, AB, BB, SF, HBP, singles, doubles, triples, HR = counts
+    if AB == 0:
+        return None
+    obp = data_utils.calculate_OBP(H, BB, HBP, AB, SF)
+    slg = data_utils.calculate_SLG(singles, doubles, triples, HR, AB)
+    return [data_utils.calculate_BA(AB, H), obp, slg, data_utils.calculate_OPS(obp, slg)]
+
+
+def new_team(state):
+    zeros = [0] * len(BATTING_COUNTS)
+    return {
+        'games': 0,
+        'last': None,
+        'splits': {split: list(zeros) for split in stats_utils.SPLITS},
+        'windows': {str(n): list(zeros) for n in state['windows']},
+        'ewma': {str(half_life): [0.0] * len(BATTING_COUNTS) for half_life in state['half_lives']},
+        'recent': [],
+        'postgame': None,
+    }
+
+
+def get_team_pregame(state, team):
+    """
+    Return the stats for a team's next game from its aggregate state, keyed
+    and ordered like the fields calculate_offensive_stats() adds to a game.
+    """
+    team_state = state['teams'].get(team)
+    if team_state is None or team_state['games'] == 0:
+        return {}
+    features = dict(zip(['pregame_BA', 'pregame_OBP', 'pregame_SLG', 'pregame_OPS'], team_state['postgame']))
+    for split in stats_utils.SPLITS:
+        line = get_batting_line(team_state['splits'][split])
+        if line is not None:
+            features.update(zip([f'{split}_{stat}' for stat in stats_utils.BATTING_STATS], line))
+    for n in state['windows']:
+        line = get_batting_line(team_state['windows'][str(n)])
+        if line is not None:
+            features.update(zip(stats_utils.window_keys(n), line))
+    for half_life in state['half_lives']:
+        line = get_batting_line(team_state['ewma'][str(half_life)])
+        if line is not None:
+            features.update(zip(stats_utils.ewma_keys(half_life), line))
+    return features
+
+
+def fold_team_game(state, team, game):
+    """
+    Add a team's game to its aggregate state. Every window is updated by
+    adding the new game and subtracting the one that drops out of it.
+    """
+    if team not in state['teams']:
+        state['teams'][team] = new_team(state)
+    team_state = state['teams'][team]
+    counts = get_batting_counts(game)
+    splits = ['home' if game['home'] else 'away', 'right' if game['opp_starter_righty'] else 'left']
+    for split in splits:
+        team_state['splits'][split] = [total + count for total, count in zip(team_state['splits'][split], counts)]
+
+    recent = collections.deque(team_state['recent'], maxlen=max(state['windows'], default=0))
+    for n in state['windows']:
+        totals = [total + count for total, count in zip(team_state['windows'][str(n)], counts)]
+        if len(recent) >= n:
+            totals = [total - count for total, count in zip(totals, recent[-n])]
+        team_state['windows'][str(n)] = totals
+    recent.append(counts)
+    team_state['recent'] = list(recent)
+
+    for half_life in state['half_lives']:
+        decay = .5 ** (1/half_life)
+        team_state['ewma'][str(half_life)] = [decay*total + count for total, count in zip(team_state['ewma'][str(half_life)], counts)]
+
+    team_state['postgame'] = [game['postgame_BA'], game['postgame_OBP'], game['postgame_SLG'], game['postgame_OPS']]
+    team_state['games'] += 1
+
+
+def get_pitching_pregame(totals):
+    """
+    Return the pregame ERA and WHIP from pitching totals, or {} with no outs
+    recorded.
+    """
+    outs, ER, BB, H = totals
+    if outs == 0:
+        return {}
+    return {'pregame_ERA': data_utils.calculate_ERA(ER, outs), 'pregame_WHIP': data_utils.calculate_WHIP(outs, BB, H)}
+
+
+def fold_pitching(aggregate, stats):
+    """
+    Add a pitching line to the running totals of a pitcher or bullpen.
+    """
+    aggregate['totals'] = [total + int(stats[stat]) for total, stat in zip(aggregate['totals'], PITCHING_TOTALS)]
+
+
+def get_new_records(records, folded):
+    """
+    Return (key, record) for each of the records that haven't been folded
+    into the state, in order of game key. Records are only ever added to
+    the end of their dict, so these are the last len(records) - folded.
+    """
+    new = itertools.islice(reversed(records.items()), max(0, len(records) - folded))
+    return sorted(((data_utils.to_game_key(date), record) for date, record in new), key=lambda item: item[0])
+
+
+def find_new_records(aggregates, season_data, count):
+    """
+    Return a map of each team or pitcher with records that aren't in the
+    state to those records, or None if any of them is older than the last
+    record folded in for its team or pitcher.
+    """
+    new = {}
+    for name, records in season_data.items():
+        aggregate = aggregates.get(name)
+        folded = aggregate[count] if aggregate is not None else 0
+        if len(records) <= folded:
+            continue
+        new[name] = get_new_records(records, folded)
+        if aggregate is not None and aggregate['last'] is not None and new[name][0][0] <= aggregate['last']:
+            return None
+    return new
+
+
+def update_state(state, season_games, pitcher_data, bullpen_data, add_stats=True):
+    """
+    Fold every game, appearance and bullpen game that isn't in the aggregate
+    state yet into it, in order of game key, and return true. With 
+    add_stats, each one first gets its pregame stats from the state, which
+    only takes the new games' own stats, not the rest of the season.
+
+    If a new record is older than one already folded in for its team or
+    pitcher (ex: a box score scraped late), the stats of the records after
+    it would be off, so false is returned and the state is left as it was;
+    the season has to be recalculated instead.
+    """
+    new_games = find_new_records(state['teams'], season_games, 'games')
+    new_appearances = find_new_records(state['pitchers'], pitcher_data, 'appearances')
+    new_bullpen_games = find_new_records(state['bullpens'], bullpen_data, 'games')
+    if new_games is None or new_appearances is None or new_bullpen_games is None:
+        return False
+
+    for team, games in new_games.items():
+        for key, game in games:
+            if add_stats:
+                game.update(get_team_pregame(state, team))
+            fold_team_game(state, team, game)
+            state['teams'][team]['last'] = key
+
+    for pitcher, appearances in new_appearances.items():
+        pitcher_state = state['pitchers'].setdefault(pitcher, {'appearances': 0, 'last': None, 'totals': [0, 0, 0, 0]})
+        for key, appearance in appearances:
+            if add_stats:
+                appearance.update(get_pitching_pregame(pitcher_state['totals']))
+            fold_pitching(pitcher_state, appearance)
+            pitcher_state['appearances'] += 1
+            pitcher_state['last'] = key
+
+    for team, games in new_bullpen_games.items():
+        bullpen_state = state['bullpens'].setdefault(team, {'games': 0, 'last': None, 'totals': [0, 0, 0, 0]})
+        for key, game in games:
+            if add_stats:
+                game.update(get_pitching_pregame(bullpen_state['totals']))
+            fold_pitching(bullpen_state, {stat: game[f'game_{stat}'] for stat in PITCHING_TOTALS})
+            bullpen_state['games'] += 1
+            bullpen_state['last'] = key
+    return True
+
+
+def is_current(state, season_games, pitcher_data, bullpen_data):
+    """
+    Return true if the state has folded in exactly the stored games, 
+    appearances and bullpen games.
+    """
+    return (all(len(season_games[team]) == state['teams'].get(team, {'games': 0})['games'] for team in season_games)
+            and all(len(pitcher_data[pitcher]) == state['pitchers'].get(pitcher, {'appearances': 0})['appearances'] for pitcher in pitcher_data)
+            and all(len(bullpen_data[team]) == state['bullpens'].get(team, {'games': 0})['games'] for team in bullpen_data))
+
+
+def build_state(season_games, pitcher_data, bullpen_data):
+    """
+    Return the aggregate state of a season's stored data, whose stats have
+    already been calculated.
+    """
+    state = new_state()
+    update_state(state, season_games, pitcher_data, bullpen_data, add_stats=False)
+    return state
@@ -0,0 +1,429 @@
+import numpy as np
+import pandas as pd
+import datetime
+import data_utils
+
+
+BATTING_COUNTS = ['H', 'AB', 'BB', 'SF', 'HBP', '1B', '2B', '3B', 'HR']
+BATTING_STATS = ['BA', 'OBP', 'SLG', 'OPS']
+SPLITS = ['home', 'away', 'right', 'left']
+
+# recent form features: last n-game stats for each window, and exponentially
+# weighted stats where a game's weight halves every half-life games
+ROLLING_WINDOWS = [10, 15]
+EWMA_HALF_LIVES = []
+
+# pitching form features: a starter's stats over their last n starts, and how
+# many outs a team's bullpen got over the last n days
+FORM_STARTS = [3]
+WORKLOAD_DAYS = [1, 3, 5]
+
+
+def get_batting_counts(games):
+    """
+    Return an int array of each batting count over a team's games, in the
+    order the games are given.
+    """
+    counts = {}
+    for stat in ['H', 'AB', 'BB', 'SF', 'HBP', '2B', '3B', 'HR']:
+        counts[stat] = np.array([game[stat] for game in games], dtype=np.int64)
+    counts['1B'] = counts['H'] - (counts['2B'] + counts['3B'] + counts['HR'])
+    return counts
+
+
+def prefix_sums(counts, mask=None):
+    """
+    Return the running totals of each count before every game:
+    sums[stat][i] is the total over games 0..i-1, so each array is one
+    longer than the number of games. Games where mask is 0 are left out.
+    """
+    sums = {}
+    for stat, values in counts.items():
+        if mask is not None:
+            values = values * mask
+        sums[stat] = np.concatenate(([0], np.cumsum(values)))
+    return sums
+
+
+def batting_stats(totals):
+    """
+    Return BA, OBP, SLG and OPS arrays from arrays of batting count totals.
+    Entries with no at bats are nan.
+    """
+    at_bats = totals['AB']
+    ba = data_utils.calculate_BA(at_bats, totals['H'])
+    obp = data_utils.calculate_OBP(totals['H'], totals['BB'], totals['HBP'], at_bats, totals['SF'])
+    slg = data_utils.calculate_SLG(totals['1B'], totals['2B'], totals['3B'], totals['HR'], at_bats)
+    ops = data_utils.calculate_OPS(obp, slg)
+    for values in [ba, obp, slg, ops]:
+        values[at_bats == 0] = np.nan
+    return ba, obp, slg, ops
+
+
+def ewma_sums(counts, half_life):
+    """
+    Return the exponentially weighted totals of each count before every
+    game, laid out like prefix_sums(): the game right before i has weight 1,
+    the one before that 0.5**(1/half_life), and so on.
+    """
+    decay = .5 ** (1/half_life)
+    values = np.stack([counts[stat] for stat in BATTING_COUNTS], axis=1).astype(float)
+    sums = np.zeros((len(values)+1, len(BATTING_COUNTS)))
+    for i in range(len(values)):
+        sums[i+1] = decay*sums[i] + values[i]
+    return {stat: sums[:, k] for k, stat in enumerate(BATTING_COUNTS)}
+
+
+def window_keys(n):
+    return [f'{n}-day_BA', f'{n}-day_OBP', f'{n}-day_SLG', f'{n}-day-OPS']
+
+
+def ewma_keys(half_life):
+    return [f'ewma-{half_life}_{stat}' for stat in BATTING_STATS]
+
+
+def get_form_columns(counts, first, windows=ROLLING_WINDOWS, half_lives=EWMA_HALF_LIVES):
+    """
+    Return the recent form stats before each game from `first` on, as a map
+    of feature name to list of values (nan where there were no at bats).
+
+    get_form_columns(counts, 1, [10], [5]) --> {'10-day_BA': [...], ..., 'ewma-5_OPS': [...]}
+    """
+    columns = {}
+    before = np.arange(first, len(counts['AB']))
+    sums = prefix_sums(counts)
+    for n in windows:
+        totals = {stat: sums[stat][before] - sums[stat][np.maximum(before-n, 0)] for stat in BATTING_COUNTS}
+        for key, values in zip(window_keys(n), batting_stats(totals)):
+            columns[key] = values.tolist()
+    for half_life in half_lives:
+        sums = ewma_sums(counts, half_life)
+        totals = {stat: sums[stat][before] for stat in BATTING_COUNTS}
+        for key, values in zip(ewma_keys(half_life), batting_stats(totals)):
+            columns[key] = values.tolist()
+    return columns
+
+
+def calculate_offensive_stats(season_games, windows=ROLLING_WINDOWS, half_lives=EWMA_HALF_LIVES):
+    """
+    Calculate each team's season home/away and RHP/LHP splits and recent
+    form stats before every game from prefix sums of the box score counts,
+    and add them to the games.
+
+    Split totals before game i are prefix sums over the games in that
+    split, and the last n-game totals are the difference of two prefix
+    sums, so a team's whole season is a handful of array operations.
+    """
+    for team in season_games:
+        games = list(season_games[team].values())
+        if len(games) < 2:
+            continue
+        counts = get_batting_counts(games)
+        home = np.array([game['home'] for game in games], dtype=np.int64)
+        righty = np.array([game['opp_starter_righty'] for game in games], dtype=np.int64)
+        masks = {'home': home, 'away': 1-home, 'right': righty, 'left': 1-righty}
+        before = np.arange(1, len(games))
+
+        # season split stats and recent form for every game after the first, in the order they're added to the game
+        columns = {}
+        for split in SPLITS:
+            sums = prefix_sums(counts, masks[split])
+            totals = {stat: sums[stat][before] for stat in BATTING_COUNTS}
+            for stat, values in zip(BATTING_STATS, batting_stats(totals)):
+                columns[f'{split}_{stat}'] = values.tolist()
+        columns.update(get_form_columns(counts, 1, windows, half_lives))
+
+        for j, game in enumerate(games[1:]):
+            prev_game = games[j]
+            game['pregame_BA'] = prev_game['postgame_BA']
+            game['pregame_OBP'] = prev_game['postgame_OBP']
+            game['pregame_SLG'] = prev_game['postgame_SLG']
+            game['pregame_OPS'] = prev_game['postgame_OPS']
+            for key, values in columns.items():
+                # nan - no at bats in the split yet
+                if values[j] == values[j]:
+                    game[key] = values[j]
+
+
+def get_form_table(season_games, windows=ROLLING_WINDOWS, half_lives=EWMA_HALF_LIVES):
+    """
+    Return a DataFrame of recent form features with one row per team game
+    (indexed by team and date), computed from stored game data without
+    touching the game records. Useful to try out other windows and
+    half-lives without scraping or recalculating a season.
+
+    get_form_table(GAME_DATA['2021'], [5, 20, 30], [3, 10])
+    """
+    tables = []
+    for team in season_games:
+        dates = list(season_games[team])
+        counts = get_batting_counts(list(season_games[team].values()))
+        columns = get_form_columns(counts, 0, windows, half_lives)
+        index = pd.MultiIndex.from_product([[team], dates], names=['team', 'date'])
+        tables.append(pd.DataFrame(columns, index=index))
+    return pd.concat(tables)
+
+
+def grouped_sums_before(values, group_starts):
+    """
+    Return the running total of values before each row within its group,
+    where group_starts[i] is the index of the first row of row i's group.
+    """
+    sums = np.cumsum(values) - values
+    return sums - sums[group_starts]
+
+
+def get_group_starts(group_sizes):
+    """
+    Return the index of the first row of each row's group, for groups of
+    rows laid out one after another.
+    [2, 3] --> [0, 0, 2, 2, 2]
+    """
+    first_rows = np.cumsum([0] + group_sizes[:-1])
+    return np.repeat(first_rows, group_sizes).astype(np.int64)
+
+
+def add_pregame_pitching(records, group_sizes, stats):
+    """
+    Add the pregame ERA and WHIP from the totals of the given (outs, ER, BB,
+    H) stats over the earlier records of each group, skipping records with
+    no earlier outs. Records are grouped in order, group_sizes long each.
+    """
+    if not records:
+        return
+    group_starts = get_group_starts(group_sizes)
+    totals = []
+    for stat in stats:
+        values = np.array([record[stat] for record in records], dtype=np.int64)
+        totals.append(grouped_sums_before(values, group_starts))
+    outs, earned_runs, walks, hits = totals
+    era = data_utils.calculate_ERA(earned_runs, outs)
+    whip = data_utils.calculate_WHIP(outs, walks, hits)
+
+    for record, record_outs, record_era, record_whip in zip(records, outs.tolist(), era.tolist(), whip.tolist()):
+        if record_outs > 0:
+            record['pregame_ERA'] = record_era
+            record['pregame_WHIP'] = record_whip
+
+
+def calculate_pitcher_stats(pitcher_data):
+    """
+    Calculate each pitcher's season ERA and WHIP before every appearance and
+    add them to the appearances.
+
+    All appearances are laid out as one table of columns, grouped by pitcher
+    in date order, and a pitcher's season totals (outs, ER, BB, H) before
+    each appearance are grouped cumulative sums of those columns.
+    """
+    appearances = [game for pitcher in pitcher_data for game in pitcher_data[pitcher].values()]
+    add_pregame_pitching(appearances, [len(pitcher_data[pitcher]) for pitcher in pitcher_data], ['outs', 'ER', 'BB', 'H'])
+
+
+def calculate_bullpen_stats(bullpen_data):
+    """
+    Calculate each bullpen's season ERA and WHIP before every game from the
+    bullpen lines of its earlier games, and add them to the games.
+    """
+    games = [game for team in bullpen_data for game in bullpen_data[team].values()]
+    add_pregame_pitching(games, [len(bullpen_data[team]) for team in bullpen_data],
+                         ['game_outs', 'game_ER', 'game_BB', 'game_H'])
+
+
+def is_start(season_games, pitcher, date, appearance):
+    """
+    Return true if the appearance was a start, i.e. the pitcher is listed
+    as the starter faced by the other team that day. The pitcher's own
+    team's game is checked too, since a few scraped appearances have the
+    teams swapped (ex: montafr02 and skubata01 on 2022-05-10); the starter
+    a team faced is never one of its own pitchers, so it can't match
+    otherwise.
+    """
+    for team in [appearance['opp'], appearance['team']]:
+        game = season_games.get(team, {}).get(date)
+        if game is not None and game.get('opp_starter_id') == pitcher:
+            return True
+    return False
+
+
+def calculate_starter_form(season_games, pitcher_data, starts=FORM_STARTS, since=None):
+    """
+    Add each starter's ERA and WHIP over their last n starts to every start
+    (ex: 'last-3-starts_ERA'), skipping starts with no earlier outs in the
+    window. With since (a date key), only pitchers who appeared on or after
+    it are looked at, and only their starts from then on are updated.
+
+    The starts of all pitchers are laid out as one table grouped by pitcher,
+    so each window is the difference of two prefix sums, with the window
+    cut off at the pitcher's first start.
+    """
+    rows, row_dates, group_sizes = [], [], []
+    for pitcher, appearances in pitcher_data.items():
+        if not appearances or (since is not None and next(reversed(appearances)) < since):
+            continue
+        pitcher_starts = [(date, game) for date, game in appearances.items() if is_start(season_games, pitcher, date, game)]
+        if pitcher_starts:
+            row_dates += [date for date, _ in pitcher_starts]
+            rows += [game for _, game in pitcher_starts]
+            group_sizes.append(len(pitcher_starts))
+    if not rows:
+        return
+    group_starts = get_group_starts(group_sizes)
+    before = np.arange(len(rows))
+
+    sums = {}
+    for stat in ['outs', 'ER', 'BB', 'H']:
+        values = np.array([game[stat] for game in rows], dtype=np.int64)
+        sums[stat] = np.concatenate(([0], np.cumsum(values)))
+    for n in starts:
+        window_start = np.maximum(group_starts, before-n)
+        totals = {stat: sums[stat][before] - sums[stat][window_start] for stat in sums}
+        era = data_utils.calculate_ERA(totals['ER'], totals['outs']).tolist()
+        whip = data_utils.calculate_WHIP(totals['outs'], totals['BB'], totals['H']).tolist()
+        for date, game, outs, game_era, game_whip in zip(row_dates, rows, totals['outs'].tolist(), era, whip):
+            if outs > 0 and (since is None or date >= since):
+                game[f'last-{n}-starts_ERA'] = game_era
+                game[f'last-{n}-starts_WHIP'] = game_whip
+
+
+def get_day(date):
+    return datetime.date.fromisoformat(date.split()[0]).toordinal()
+
+
+def get_dates_from(records, day):
+    """
+    Return the dates of the records played on or after the day (an
+    ordinal), walking back from the last record.
+    """
+    dates = []
+    for date in reversed(records):
+        if get_day(date) < day:
+            break
+        dates.append(date)
+    return dates[::-1]
+
+
+def calculate_bullpen_workload(bullpen_data, days=WORKLOAD_DAYS, since=None):
+    """
+    Add the number of outs each team's bullpen recorded over the n days
+    before every game (ex: '3-day_outs'), counting an earlier game of a
+    doubleheader as the same day. With since (a date key), only the games
+    from then on are updated, and only the games in their windows are read.
+
+    Each window is found by binary search on the day of each game, and its
+    outs are the difference of two prefix sums.
+    """
+    for team_bullpen in bullpen_data.values():
+        if since is None:
+            dates = list(team_bullpen)
+        else:
+            dates = get_dates_from(team_bullpen, get_day(since) - max(days))
+        if not dates:
+            continue
+        games = [team_bullpen[date] for date in dates]
+        game_days = np.array([get_day(date) for date in dates])
+        sums = np.concatenate(([0], np.cumsum([game['game_outs'] for game in games])))
+        before = np.arange(len(games))
+        for n in days:
+            window_start = np.searchsorted(game_days, game_days-n, side='left')
+            outs = (sums[before] - sums[window_start]).tolist()
+            for date, game, window_outs in zip(dates, games, outs):
+                if since is None or date >= since:
+                    game[f'{n}-day_outs'] = window_outs
+
+
+def sums_before(days, values, index_days):
+    """
+    Return the total of values on days before each of index_days, from one
+    sort of the days and a prefix sum.
+    """
+    order = np.argsort(days, kind='stable')
+    sums = np.concatenate(([0], np.cumsum(np.asarray(values)[order])))
+    return sums[np.searchsorted(days[order], index_days, side='left')]
+
+
+def get_league_index(season_games, pitcher_data, since=None):
+    """
+    Return the league's OBP, SLG and ERA over every game before each date
+    of the season (or each date from since on), keyed by date.
+
+    league_index['2021-07-19'] = {'OBP': .317, 'SLG': .409, 'ERA': 4.26}
+    """
+    batting_days, batting = [], {stat: [] for stat in BATTING_COUNTS}
+    for games in season_games.values():
+        for date, game in games.items():
+            batting_days.append(date.split()[0])
+            batting['1B'].append(game['H'] - (game['2B'] + game['3B'] + game['HR']))
+            for stat in BATTING_COUNTS:
+                if stat != '1B':
+                    batting[stat].append(game[stat])
+    pitching_days, pitching = [], {'outs': [], 'ER': []}
+    for appearances in pitcher_data.values():
+        for date, game in appearances.items():
+            pitching_days.append(date.split()[0])
+            pitching['outs'].append(game['outs'])
+            pitching['ER'].append(int(game['ER']))
+    batting_days, pitching_days = np.array(batting_days), np.array(pitching_days)
+    index_days = np.unique(np.concatenate((batting_days, pitching_days)))
+    if since is not None:
+        index_days = index_days[index_days >= since.split()[0]]
+    if len(index_days) == 0:
+        return {}
+
+    totals = {stat: sums_before(batting_days, batting[stat], index_days) for stat in BATTING_COUNTS}
+    totals.update({stat: sums_before(pitching_days, pitching[stat], index_days) for stat in pitching})
+    with np.errstate(divide='ignore', invalid='ignore'):
+        obp = (totals['H'] + totals['BB'] + totals['HBP']) / (totals['AB'] + totals['SF'] + totals['HBP'] + totals['BB'])
+        slg = (totals['1B'] + 2*totals['2B'] + 3*totals['3B'] + 4*totals['HR']) / totals['AB']
+        era = totals['ER']*9 / data_utils.outs_to_innings(totals['outs'])
+    return {day: {'OBP': day_obp, 'SLG': day_slg, 'ERA': day_era}
+            for day, day_obp, day_slg, day_era in zip(index_days.tolist(), obp.tolist(), slg.tolist(), era.tolist())}
+
+
+def add_ERA_minus(game, league, prefixes):
+    """
+    Add ERA- (100 is league average, lower is better) for each ERA in the
+    game with one of the prefixes.
+    """
+    for prefix in prefixes:
+        if f'{prefix}_ERA' in game and league['ERA'] > 0:
+            game[f'{prefix}_ERA-'] = round(100 * game[f'{prefix}_ERA'] / league['ERA'])
+
+
+def get_dates_since(records, since):
+    """
+    Return the dates of the records, or of the ones played on or after
+    since (a date key) if it's given.
+    """
+    return list(records) if since is None else get_dates_from(records, get_day(since))
+
+
+def calculate_league_adjusted(season_games, pitcher_data, bullpen_data, since=None):
+    """
+    Add league-adjusted versions of the pregame stats: OPS+ for each batting
+    line in the game data (ex: 'home_OPS+'), and ERA- for the pitcher and
+    bullpen ERAs (ex: 'pregame_ERA-'). Both compare against the league over
+    every game before that date, so 100 is league average in any season.
+    With since (a date key), only the games from then on are updated.
+    """
+    league_index = get_league_index(season_games, pitcher_data, since)
+    batting_lines = (['pregame'] + SPLITS + [f'{n}-day' for n in ROLLING_WINDOWS]
+                     + [f'ewma-{half_life}' for half_life in EWMA_HALF_LIVES])
+    for games in season_games.values():
+        for date in get_dates_since(games, since):
+            game = games[date]
+            league = league_index[date.split()[0]]
+            # nan - first day of the season
+            if not league['OBP'] > 0 or not league['SLG'] > 0:
+                continue
+            for prefix in batting_lines:
+                if f'{prefix}_OBP' in game:
+                    ops_plus = game[f'{prefix}_OBP']/league['OBP'] + game[f'{prefix}_SLG']/league['SLG'] - 1
+                    game[f'{prefix}_OPS+'] = round(100 * ops_plus)
+
+    starter_lines = ['pregame'] + [f'last-{n}-starts' for n in FORM_STARTS]
+    for appearances in pitcher_data.values():
+        for date in get_dates_since(appearances, since):
+            add_ERA_minus(appearances[date], league_index[date.split()[0]], starter_lines)
+    for team_bullpen in bullpen_data.values():
+        for date in get_dates_since(team_bullpen, since):
+            add_ERA_minus(team_bullpen[date], league_index[date.split()[0]], ['pregame'])
@@ -0,0 +1,283 @@
+import os
+import collections.abc
+import pandas as pd
+import numpy as np
+import data_utils, table_utils
+
+# pyarrow is only needed for the columnar files; without it everything
+# keeps reading and writing the json files
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# entity --> (json file, name of the column holding the team or pitcher)
+ENTITIES = {
+    'games': ('game-data.json', 'team'),
+    'pitchers': ('pitcher-data.json', 'pitcher'),
+    'bullpens': ('team-bullpen-data.json', 'team'),
+}
+# the json key of a record is kept in 'game', since game records have a date
+# stat that drops the doubleheader suffix
+KEY_COLUMNS = ['season', 'game', 'key']
+# the in-memory table each entity is held in by a compact SeasonStore
+TABLES = {'games': table_utils.GameTable, 'pitchers': table_utils.PitcherTable, 'bullpens': table_utils.GameTable}
+
+
+def require_arrow():
+    if pa is None:
+        raise ImportError('Columnar storage needs pyarrow (pip install pyarrow)')
+
+
+def columnar_file(year, entity):
+    return f'data/{year}/{entity}.parquet'
+
+
+def has_columnar(year):
+    """
+    Return true if the year's data has been stored in columnar files.
+    """
+    return pa is not None and all(os.path.isfile(columnar_file(year, entity)) for entity in ENTITIES)
+
+
+def get_dtype(values):
+    """
+    Return the nullable pandas dtype that holds every value of a column.
+    """
+    kinds = {type(value) for value in values if value is not None}
+    if kinds <= {bool}:
+        return 'boolean'
+    if kinds <= {int}:
+        return 'Int64'
+    if kinds <= {int, float}:
+        return 'Float64'
+    if kinds <= {str}:
+        return 'string'
+    return object
+
+
+def to_frame(season_data, name_column, year):
+    """
+    Return a season of json data as a DataFrame with one row per record,
+    keyed by season, team or pitcher, json key ('game') and integer game key, and one
+    typed column per stat. Stats a record doesn't have are missing (<NA>).
+
+    to_frame(pitcher_data['2021'], 'pitcher', '2021')
+    """
+    rows = [(name, date, record) for name, records in season_data.items() for date, record in records.items()]
+    stats = list(dict.fromkeys(stat for _, _, record in rows for stat in record))
+    columns = {
+        'season': pd.array([str(year)] * len(rows), dtype='string'),
+        name_column: pd.array([name for name, _, _ in rows], dtype='string'),
+        'game': pd.array([date for _, date, _ in rows], dtype='string'),
+        'key': pd.array([data_utils.to_game_key(date) for _, date, _ in rows], dtype='Int64'),
+    }
+    for stat in stats:
+        if stat in columns:
+            raise ValueError(f'Stat {stat} has the name of a key column')
+        values = [record.get(stat) for _, _, record in rows]
+        columns[stat] = pd.array(values, dtype=get_dtype(values))
+    return pd.DataFrame(columns)
+
+
+def to_season_data(frame, name_column):
+    """
+    Return the records of a DataFrame in the json shape, leaving out missing
+    stats. Records are filled a column at a time.
+
+    season_data['BOS']['2021-08-17 (2)'] = {'AB': 34, ...}
+    """
+    records = [{} for _ in range(len(frame))]
+    for stat in frame.columns:
+        if stat in KEY_COLUMNS or stat == name_column:
+            continue
+        column = frame[stat]
+        values = column.tolist()
+        if column.dtype == object:
+            # lists come back from parquet as arrays
+            values = [value.tolist() if isinstance(value, np.ndarray) else value for value in values]
+        missing = column.isna().to_numpy()
+        if missing.any():
+            for record, value, is_missing in zip(records, values, missing.tolist()):
+                if not is_missing:
+                    record[stat] = value
+        else:
+            for record, value in zip(records, values):
+                record[stat] = value
+
+    season_data = {}
+    for name, game, record in zip(frame[name_column].tolist(), frame['game'].tolist(), records):
+        season_data.setdefault(name, {})[game] = record
+    return season_data
+
+
+def read_frame(year, entity):
+    """
+    Return the year's columnar table of an entity as a DataFrame with
+    nullable columns.
+    """
+    require_arrow()
+    types = {pa.int64(): pd.Int64Dtype(), pa.float64(): pd.Float64Dtype(), pa.bool_(): pd.BooleanDtype(),
+             pa.string(): pd.StringDtype(), pa.large_string(): pd.StringDtype()}
+    return pq.read_table(columnar_file(year, entity)).to_pandas(types_mapper=types.get)
+
+
+def dump_columnar(year, game_data, pitcher_data, bullpen_data):
+    """
+    Write a season's data to the year's columnar files.
+    """
+    require_arrow()
+    os.makedirs(f'data/{year}', exist_ok=True)
+    for entity, season_data in zip(ENTITIES, [game_data, pitcher_data, bullpen_data]):
+        frame = to_frame(season_data, ENTITIES[entity][1], year)
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        pq.write_table(table, columnar_file(year, entity) + '.tmp', compression='zstd')
+        os.replace(columnar_file(year, entity) + '.tmp', columnar_file(year, entity))
+
+
+def convert_json(year):
+    """
+    Write the columnar files of a year from its json files.
+    """
+    game_data = data_utils.load_data(year, 'game-data.json')
+    pitcher_data = data_utils.load_data(year, 'pitcher-data.json')
+    bullpen_data = data_utils.load_data(year, 'team-bullpen-data.json')
+    data_utils.add_outs(pitcher_data, bullpen_data)
+    dump_columnar(year, game_data, pitcher_data, bullpen_data)
+
+
+def get_years(start_year, end_year):
+    return [str(year) for year in range(start_year, end_year+1) if year != 2020]
+
+
+def get_data_files(years):
+    """
+    Return the paths of the json and columnar files stored for the years.
+    """
+    files = []
+    for year in years:
+        for entity, (file, _) in ENTITIES.items():
+            files += [path for path in [f'data/{year}/{file}', columnar_file(year, entity)] if os.path.isfile(path)]
+    return files
+
+
+def load_frames(start_year, end_year):
+    """
+    Return DataFrames of the games, pitcher appearances and bullpen games of
+    every year, read from the columnar files where they exist and from the
+    json files otherwise.
+    """
+    frames = {entity: [] for entity in ENTITIES}
+    for year in get_years(start_year, end_year):
+        columnar = has_columnar(year)
+        for entity, (file, name_column) in ENTITIES.items():
+            if columnar:
+                frames[entity].append(read_frame(year, entity))
+            else:
+                frames[entity].append(to_frame(data_utils.load_data(year, file), name_column, year))
+    return tuple(pd.concat(frames[entity], ignore_index=True) for entity in ENTITIES)
+
+
+def load_season(year, entity):
+    """
+    Return a year's data of one entity in the json shape, read from the
+    columnar file if the year has been converted.
+
+    load_season('2021', 'bullpens')['BOS']['2021-08-17 (2)'] --> {'game_IP': 3.1, ...}
+    """
+    file, name_column = ENTITIES[entity]
+    if has_columnar(year):
+        season_data = to_season_data(read_frame(year, entity), name_column)
+    else:
+        season_data = data_utils.load_data(year, file)
+    if entity == 'pitchers':
+        data_utils.add_outs(pitcher_data=season_data)
+    elif entity == 'bullpens':
+        data_utils.add_outs(bullpen_data=season_data)
+    return season_data
+
+
+def get_data_dicts(start_year, end_year):
+    """
+    Load the game, pitcher and bullpen data of each year into separate
+    dictionaries (year --> team or pitcher --> date --> stats) and return
+    them, reading the columnar files where they exist.
+    """
+    years = get_years(start_year, end_year)
+    return tuple({year: load_season(year, entity) for year in years} for entity in ENTITIES)
+
+
+class LazySeasons(collections.abc.Mapping):
+    """
+    Read-only map of year --> season data of one entity, which only loads a
+    season the first time it is looked up.
+    """
+    def __init__(self, store, entity):
+        self.store = store
+        self.entity = entity
+
+    def __getitem__(self, year):
+        return self.store.get_season(year, self.entity)
+
+    def __iter__(self):
+        return iter(self.store.years)
+
+    def __len__(self):
+        return len(self.store.years)
+
+
+class SeasonStore:
+    """
+    The stored data of a range of years, loaded on first use instead of up
+    front. Each file of a season is loaded the first time it is looked up
+    and kept until it is evicted. With compact, seasons are kept in
+    read-only NumPy tables (see table_utils) rather than nested dicts.
+
+    store = SeasonStore(2010, 2022, compact=True)
+    store.games['2021']['BOS']            # only loads 2021's game data
+    store.index.get_bullpen('2021', 'BOS', key)
+    store.preload(['2021'])               # load every file of 2021 now
+    store.evict('2021')                   # free 2021's data and index
+    """
+    def __init__(self, start_year, end_year, compact=False):
+        self.years = get_years(start_year, end_year)
+        self.compact = compact
+        self.seasons = {}
+        self.games = LazySeasons(self, 'games')
+        self.pitchers = LazySeasons(self, 'pitchers')
+        self.bullpens = LazySeasons(self, 'bullpens')
+        self.index = data_utils.GameIndex(self.games, self.pitchers, self.bullpens)
+
+    def get_season(self, year, entity):
+        year = str(year)
+        if year not in self.years:
+            raise KeyError(year)
+        if (year, entity) not in self.seasons:
+            season_data = load_season(year, entity)
+            self.seasons[(year, entity)] = TABLES[entity](season_data) if self.compact else season_data
+        return self.seasons[(year, entity)]
+
+    def is_loaded(self, year, entity):
+        return (str(year), entity) in self.seasons
+
+    def preload(self, years=None, entities=ENTITIES):
+        """
+        Load the given files of the given years (all by default) now rather
+        than on first use.
+        """
+        for year in (self.years if years is None else years):
+            for entity in entities:
+                self.get_season(year, entity)
+
+    def evict(self, year=None):
+        """
+        Drop the loaded data and index of a year, or of every year. They are
+        loaded again the next time they're looked up.
+        """
+        for loaded_year, entity in list(self.seasons):
+            if year is None or loaded_year == str(year):
+                del self.seasons[(loaded_year, entity)]
+        self.index.evict(None if year is None else str(year))
@@ -0,0 +1,251 @@
+import collections.abc
+import numpy as np
+import data_utils
+
+
+# stands in for a stat a record doesn't have while the columns are built
+MISSING = object()
+
+
+def get_kind(values):
+    """
+    Return how a column is stored: 'bool', 'int', 'float', 'str',
+    'str_list' (lists of strings) or 'object' (anything else).
+    """
+    kinds = {type(value) for value in values if value is not MISSING}
+    if kinds == {list} and all(type(item) == str for value in values if value is not MISSING for item in value):
+        return 'str_list'
+    if kinds <= {bool}:
+        return 'bool'
+    if kinds <= {int}:
+        return 'int'
+    if kinds <= {int, float}:
+        return 'float'
+    if kinds <= {str}:
+        return 'str'
+    return 'object'
+
+
+def get_int_dtype(values):
+    """
+    Return the smallest integer dtype that holds every value.
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if len(values) == 0 or (values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max):
+            return dtype
+    return np.int64
+
+
+class RecordTable(collections.abc.Mapping):
+    """
+    A season of records (name --> date --> stats) held in one typed NumPy
+    column per stat instead of a dict per record. Numbers, booleans and
+    strings take a few bytes per record; strings are stored as codes into
+    a list of the distinct values, and lists of strings as one array of
+    codes with the offset where each record's list starts. A column that
+    some records don't have keeps a mask of the records that do, and a
+    float column with some int values keeps a mask of the records whose
+    value was an int, so every value reads back as the type it had.
+
+    The table reads like the json data it was built from:
+
+    table['BOS']['2021-08-17 (2)']['pregame_BA'] --> .251
+    'home_BA' in table['BOS']['2021-04-01'] --> False
+
+    and whole columns can be used directly:
+
+    table.column('pregame_BA')[table.get_rows('BOS')]
+
+    Each name's records are kept in order of their game keys. The views
+    are read-only.
+    """
+    name_column = 'name'
+
+    def __init__(self, season_data):
+        records = []
+        self.row_ranges = {}
+        for name, name_records in season_data.items():
+            ordered = sorted(name_records.items(), key=lambda item: data_utils.to_game_key(item[0]))
+            self.row_ranges[name] = (len(records), len(records) + len(ordered))
+            records.extend(ordered)
+        self.keys = np.array([data_utils.to_game_key(date) for date, _ in records], dtype=np.int64)
+        stats = list(dict.fromkeys(stat for _, record in records for stat in record))
+        self.kinds, self.values, self.present, self.ints, self.categories, self.offsets = {}, {}, {}, {}, {}, {}
+        for stat in stats:
+            self.add_column(stat, [record.get(stat, MISSING) for _, record in records])
+
+    def add_column(self, stat, values):
+        kind = get_kind(values)
+        present = np.array([value is not MISSING for value in values], dtype=bool)
+        self.kinds[stat] = kind
+        self.present[stat] = None if present.all() else present
+        if kind == 'str':
+            self.categories[stat] = sorted({value for value in values if value is not MISSING})
+            codes = {value: code for code, value in enumerate(self.categories[stat])}
+            codes = np.array([codes.get(value, -1) for value in values], dtype=np.int64)
+            self.values[stat] = codes.astype(get_int_dtype(codes))
+        elif kind == 'str_list':
+            lists = [[] if value is MISSING else value for value in values]
+            self.categories[stat] = sorted({item for value in lists for item in value})
+            codes = {value: code for code, value in enumerate(self.categories[stat])}
+            codes = np.array([codes[item] for value in lists for item in value], dtype=np.int64)
+            self.values[stat] = codes.astype(get_int_dtype(codes))
+            self.offsets[stat] = np.cumsum([0] + [len(value) for value in lists]).astype(np.int32)
+        elif kind == 'object':
+            self.values[stat] = np.empty(len(values), dtype=object)
+            self.values[stat][:] = [None if value is MISSING else value for value in values]
+        elif kind == 'int':
+            ints = np.array([0 if value is MISSING else value for value in values], dtype=np.int64)
+            self.values[stat] = ints.astype(get_int_dtype(ints))
+        else:
+            dtype, fill = {'bool': (bool, False), 'float': (np.float64, np.nan)}[kind]
+            self.values[stat] = np.array([fill if value is MISSING else value for value in values], dtype=dtype)
+        if kind == 'float':
+            ints = np.array([type(value) == int for value in values], dtype=bool)
+            self.ints[stat] = ints if ints.any() else None
+
+    def __getitem__(self, name):
+        if name not in self.row_ranges:
+            raise KeyError(name)
+        return NameView(self, name)
+
+    def __iter__(self):
+        return iter(self.row_ranges)
+
+    def __len__(self):
+        return len(self.row_ranges)
+
+    def get_rows(self, name):
+        """
+        Return the slice of rows holding a name's records.
+        """
+        return slice(*self.row_ranges[name])
+
+    def get_row(self, name, key):
+        """
+        Return the row of a name's record by its integer game key, or None.
+        """
+        if name not in self.row_ranges:
+            return None
+        start, end = self.row_ranges[name]
+        row = start + int(np.searchsorted(self.keys[start:end], key))
+        return row if row < end and self.keys[row] == key else None
+
+    def has_stat(self, row, stat):
+        return stat in self.kinds and (self.present[stat] is None or bool(self.present[stat][row]))
+
+    def get_stat(self, row, stat):
+        """
+        Return a record's stat as the python value it was stored from.
+        """
+        if not self.has_stat(row, stat):
+            raise KeyError(stat)
+        kind = self.kinds[stat]
+        if kind == 'str':
+            return self.categories[stat][self.values[stat][row]]
+        if kind == 'str_list':
+            start, end = self.offsets[stat][row], self.offsets[stat][row+1]
+            return [self.categories[stat][code] for code in self.values[stat][start:end]]
+        if kind == 'object':
+            return self.values[stat][row]
+        if kind == 'float' and self.ints[stat] is not None and self.ints[stat][row]:
+            return int(self.values[stat][row])
+        return self.values[stat][row].item()
+
+    def get_stats(self, row):
+        return [stat for stat in self.kinds if self.present[stat] is None or self.present[stat][row]]
+
+    def column(self, stat):
+        """
+        Return a whole column as an array, with nan (or None) where a record
+        doesn't have the stat. String and list columns are returned as object
+        arrays of the strings and lists.
+        """
+        kind = self.kinds[stat]
+        present = self.present[stat]
+        if kind == 'str_list':
+            values = np.empty(len(self.keys), dtype=object)
+            values[:] = [self.get_stat(row, stat) if self.has_stat(row, stat) else None for row in range(len(self.keys))]
+        elif kind == 'str':
+            values = np.array(self.categories[stat] + [None], dtype=object)[self.values[stat]]
+        elif kind == 'object':
+            values = self.values[stat]
+        else:
+            values = self.values[stat].astype(np.float64) if present is not None else self.values[stat]
+        if present is not None and kind not in ['str', 'str_list', 'object']:
+            values = np.where(present, values, np.nan)
+        return values
+
+    def nbytes(self):
+        """
+        Return roughly how many bytes the columns take.
+        """
+        masks = list(self.present.values()) + list(self.ints.values())
+        arrays = list(self.values.values()) + list(self.offsets.values()) + [mask for mask in masks if mask is not None]
+        return self.keys.nbytes + sum(array.nbytes for array in arrays)
+
+
+class GameTable(RecordTable):
+    """
+    A season of team games or bullpen games, keyed by team.
+    """
+    name_column = 'team'
+
+
+class PitcherTable(RecordTable):
+    """
+    A season of pitcher appearances, keyed by pitcher ID.
+    """
+    name_column = 'pitcher'
+
+
+class NameView(collections.abc.Mapping):
+    """
+    Read-only map of date --> record of one team or pitcher in a table.
+    """
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __getitem__(self, date):
+        try:
+            key = data_utils.to_game_key(date)
+        except (ValueError, TypeError):
+            raise KeyError(date)
+        row = self.table.get_row(self.name, key)
+        if row is None or data_utils.from_game_key(key) != date:
+            raise KeyError(date)
+        return RecordView(self.table, row)
+
+    def __iter__(self):
+        return (data_utils.from_game_key(int(key)) for key in self.table.keys[self.table.get_rows(self.name)])
+
+    def __len__(self):
+        start, end = self.table.row_ranges[self.name]
+        return end - start
+
+
+class RecordView(collections.abc.Mapping):
+    """
+    Read-only map of stat --> value of one record in a table.
+    """
+    __slots__ = ['table', 'row']
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, stat):
+        return self.table.get_stat(self.row, stat)
+
+    def __contains__(self, stat):
+        return self.table.has_stat(self.row, stat)
+
+    def __iter__(self):
+        return iter(self.table.get_stats(self.row))
+
+    def __len__(self):
+        return len(self.table.get_stats(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
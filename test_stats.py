@@ -1,11 +1,19 @@
 
 import random as rand
 import datetime
-import data_utils, model_utils
+import tempfile
+import os
+import multiprocessing
+import time
+import pytest
+import requests
+import numpy as np
+import data_utils, stats_utils, state_utils, storage_utils, table_utils, model_utils, cache_utils, request_utils
 import get_data
 
 
-GAME_DATA, PITCHER_DATA, BULLPEN_DATA = data_utils.get_data_dicts(2010, 2021)
+DATA = storage_utils.SeasonStore(2010, 2021)
+GAME_DATA, PITCHER_DATA, BULLPEN_DATA = DATA.games, DATA.pitchers, DATA.bullpens
 YEARS = list(GAME_DATA.keys())
 
 
@@ -63,9 +71,258 @@ def test_game_keys():
                         assert(cat in keys)
 
 
+def test_integer_game_keys():
+    """
+    Test that integer game keys round trip, sort by date then game number,
+    and index the loaded data.
+    """
+    dates = ['2021-08-16', '2021-08-17', '2021-08-17 (2)', '2021-08-18']
+    keys = [data_utils.to_game_key(date) for date in dates]
+    assert(keys == sorted(keys))
+    assert([data_utils.from_game_key(key) for key in keys] == dates)
+    assert(data_utils.game_key_year(keys[2]) == '2021')
+    assert(data_utils.get_weekdays(keys[2]) == [0, 1, 0, 0, 0, 0, 0])
+    index = data_utils.GameIndex({'2021': {'BOS': {date: {'R': i} for i, date in enumerate(dates)}}}, {}, {})
+    assert(index.get_game('2021', 'BOS', keys[2]) == {'R': 2})
+    assert(index.get_game('2021', 'NYY', keys[2]) is None)
+
+
+def test_columnar_round_trip():
+    """
+    Test that season data turned into a typed frame and back keeps every
+    record, stat and value type, including doubleheaders and missing stats.
+    """
+    season_data = {'BOS': {'2021-08-17': {'date': '2021-08-17', 'AB': 34, 'ER': 2.0, 'night_game': 1.0, 'opp_pitchers': ['a', 'b']},
+                           '2021-08-17 (2)': {'date': '2021-08-17', 'AB': 30, 'ER': 0.0, 'night_game': 0.0, 'opp_pitchers': ['c'],
+                                              'pregame_BA': .251}},
+                   'NYY': {'2021-08-18': {'date': '2021-08-18', 'AB': 29, 'ER': 4.0, 'night_game': 1.0, 'opp_pitchers': []}}}
+    frame = storage_utils.to_frame(season_data, 'team', '2021')
+    assert(len(frame) == 3)
+    assert(str(frame['AB'].dtype) == 'Int64' and str(frame['ER'].dtype) == 'Float64')
+    assert(list(frame['key']) == [data_utils.to_game_key(date) for date in ['2021-08-17', '2021-08-17 (2)', '2021-08-18']])
+    round_trip = storage_utils.to_season_data(frame, 'team')
+    assert(round_trip == season_data)
+    assert(type(round_trip['BOS']['2021-08-17']['ER']) == float and type(round_trip['NYY']['2021-08-18']['AB']) == int)
+
+
+def test_columnar_files(tmp_path, monkeypatch):
+    """
+    Test that a season written to parquet files reads back as the same
+    season data and frames.
+    """
+    pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    game_data = {'BOS': {'2021-08-17': {'date': '2021-08-17', 'AB': 34, 'ER': 2.0, 'opp_pitchers': ['a', 'b']},
+                         '2021-08-17 (2)': {'date': '2021-08-17', 'AB': 30, 'ER': 0.0, 'opp_pitchers': [], 'pregame_BA': .251}}}
+    pitcher_data = {'salech01': {'2021-08-17': {'IP': 6.0, 'outs': 18, 'ER': 2.0, 'team': 'BOS'}}}
+    bullpen_data = {'BOS': {'2021-08-17': {'game_IP': 3.0, 'game_outs': 9, 'game_ER': 0.0}}}
+    storage_utils.dump_columnar('2021', game_data, pitcher_data, bullpen_data)
+    assert(storage_utils.has_columnar('2021'))
+    assert(storage_utils.load_season('2021', 'games') == game_data)
+    assert(storage_utils.load_season('2021', 'pitchers') == pitcher_data)
+    assert(storage_utils.load_season('2021', 'bullpens') == bullpen_data)
+    games, pitchers, bullpens = storage_utils.load_frames(2021, 2021)
+    assert(list(games['AB']) == [34, 30] and len(pitchers) == 1 and len(bullpens) == 1)
+
+
+def test_game_table():
+    """
+    Test that a game table reads the same as the season data it was built
+    from, keeps stat types, and knows which stats a record doesn't have.
+    """
+    season_data = {'BOS': {'2021-08-17': {'AB': 34, 'ER': 2.0, 'opp': 'NYY', 'home': True, 'opp_pitchers': ['a', 'b']},
+                           '2021-08-17 (2)': {'AB': 30, 'ER': 1, 'opp': 'NYY', 'home': False, 'opp_pitchers': [],
+                                              'pregame_BA': .251}},
+                   'NYY': {'2021-08-18': {'AB': 300, 'ER': 4.5, 'opp': 'BOS', 'home': True, 'opp_pitchers': ['c']}}}
+    table = table_utils.GameTable(season_data)
+    assert(table == season_data)
+    assert(list(table['BOS']) == ['2021-08-17', '2021-08-17 (2)'])
+    assert(type(table['NYY']['2021-08-18']['AB']) == int and type(table['BOS']['2021-08-17']['ER']) == float)
+    assert(type(table['BOS']['2021-08-17 (2)']['ER']) == int and table.column('ER').dtype == np.float64)
+    assert('pregame_BA' not in table['BOS']['2021-08-17'] and '2021-08-19' not in table['BOS'])
+    assert(table['BOS']['2021-08-17']['opp_pitchers'] == ['a', 'b'])
+    assert(np.isnan(table.column('pregame_BA')[0]) and table.column('pregame_BA')[1] == .251)
+    assert(list(table.column('AB')[table.get_rows('BOS')]) == [34, 30])
+
+    index = data_utils.GameIndex({'2021': table}, {}, {'2021': table})
+    key = data_utils.to_game_key('2021-08-17 (2)')
+    assert(index.get_game('2021', 'BOS', key)['AB'] == 30 and index.get_bullpen('2021', 'NYY', key) is None)
+    assert([game['AB'] for _, game in index.get_team_games('2021', 'BOS')] == [34, 30])
+
+
+def test_game_database():
+    """
+    Test point lookups and date ranges in the database, including
+    doubleheaders and odds merged into the games.
+    """
+    game_data = {'BOS': {'2021-08-17': {'R': 3, 'open_over_under': 8.5, 'close_over_under': 9.0, 'open_ou_odds': -110},
+                         '2021-08-17 (2)': {'R': 5},
+                         '2021-08-18': {'R': 1}}}
+    pitcher_data = {'salech01': {'2021-08-17': {'outs': 18, 'ER': 2}}}
+    bullpen_data = {'BOS': {'2021-08-17': {'game_outs': 9, 'game_ER': 1}}}
+    with tempfile.TemporaryDirectory() as folder:
+        db = data_utils.GameDatabase(os.path.join(folder, 'test.sqlite'))
+        db.add_season('2021', game_data, pitcher_data, bullpen_data)
+        assert(db.get_game('BOS', '2021-08-17 (2)') == {'R': 5})
+        assert(db.get_game('BOS', '2021-08-19') is None)
+        assert([date for date, _ in db.get_team_games('BOS', '2021-08-17', '2021-08-17')] == ['2021-08-17', '2021-08-17 (2)'])
+        assert(db.get_appearance('salech01', '2021-08-17')['outs'] == 18)
+        assert(db.get_bullpen('BOS', '2021-08-17')['game_ER'] == 1)
+        assert(db.get_most_recent_game('BOS') == ('2021-08-18', {'R': 1}))
+        assert(db.get_odds('BOS', '2021-08-17') == {'open_over_under': 8.5, 'close_over_under': 9.0, 'open_ou_odds': -110})
+        game_data['BOS']['2021-08-18'].update({'open_over_under': 7.5, 'close_over_under': 7.0, 'open_ou_odds': -105})
+        db.add_games('2021', game_data)
+        assert(db.get_odds('BOS', '2021-08-18')['open_ou_odds'] == -105 and db.get_game('BOS', '2021-08-18')['R'] == 1)
+        assert(db.get_appearance('salech01', '2021-08-17')['outs'] == 18)
+        assert(data_utils.get_appearance(db, '2021', 'salech01', '2021-08-17') == {'outs': 18, 'ER': 2})
+        with pytest.raises(KeyError):
+            data_utils.get_bullpen_game(db, '2021', 'BOS', '2021-08-18')
+        db.close()
+
+
+def test_parse_gamelog_table():
+    """
+    Test that game log rows are parsed into typed columns, skipping repeated
+    headers and suspended games.
+    """
+    header = '<tr><th data-stat="ranker">Rk</th><th data-stat="date_game">Date</th><th data-stat="team_homeORaway"></th><th data-stat="opp_ID">Opp</th><th data-stat="H">H</th><th data-stat="batting_avg">BA</th></tr>'
+    page = f'''<table id="team_batting_gamelogs"><thead>{header}</thead><tbody>
+        <tr><th>1</th><td data-stat="date_game" csk="2021-04-02.001">Apr 2</td><td>@</td><td>BAL</td><td>7</td><td>.226</td></tr>
+        <tr class="thead">{header[4:]}
+        <tr><th>2</th><td data-stat="date_game" csk="2021-04-03.002">Apr 3 (suspended)</td><td></td><td>BAL</td><td>3</td><td>.200</td></tr>
+        <tr><th>3</th><td data-stat="date_game" csk="2021-04-04.003">Apr 4</td><td></td><td>TBR</td><td>12</td><td>.281</td></tr>
+    </tbody></table>'''
+    table = data_utils.parse_gamelog_table(page, 'team_batting_gamelogs', ['date', 'home', 'opp', 'H', 'postgame_BA'])
+    assert(table['date'] == ['2021-04-02', '2021-04-04'])
+    assert(table['home'] == [1, 0])
+    assert(table['opp'] == ['BAL', 'TBR'])
+    assert(table['H'] == [7, 12])
+    assert(table['postgame_BA'] == [.226, .281])
+
+
+def box_score_page(meta='<div>Second game of doubleheader</div>', weather='72&deg; F, Wind 5mph'):
+    """
+    Return a small box score page with one pitcher on each side.
+    """
+    lines = ['<title>Boston Red Sox at New York Yankees Box Score, August 17, 2021 | Baseball-Reference.com</title>',
+             f'<div class="scorebox_meta"><div>Tuesday, August 17, 2021</div>{meta}<div>Night Game, on grass</div></div>']
+    if weather:
+        lines.append(f'<div><strong>Start Time Weather:</strong> {weather}</div>')
+    lines.append('<div id="all_lineups">')
+    for id, name in [('salech01', 'Chris Sale'), ('colege01', 'Gerrit Cole')]:
+        lines += ['<tr><td>9</td>', f'<td><a href="/players/{id[0]}/{id}.shtml">{name}</a></td>', '<td>P</td></tr>']
+    lines.append('</div>')
+    for id, name, ip, er in [('salech01', 'Chris Sale', '6.1', '2'), ('colege01', 'Gerrit Cole', '7.0', '0')]:
+        lines.append(f'<!-- <tr><th data-append-csv="{id}"><a href="/players/{id[0]}/{id}.shtml">{name}</a></th><td data-stat="IP">{ip}</td>'
+                     f'<td data-stat="ER">{er}</td><td data-stat="H">5</td><td data-stat="BB">1</td></tr>')
+        lines.append(f'<tr><th>Team Totals</th><td data-stat="IP">{ip}</td><td data-stat="ER">{er}</td><td data-stat="H">5</td><td data-stat="BB">1</td></tr> -->')
+    return '\n'.join(lines)
+
+
+def test_parse_box_score():
+    """
+    Test that a box score page is parsed in one pass, that suspended games
+    only come back flagged, and that a page without weather is an error.
+    """
+    box_score = data_utils.parse_box_score(box_score_page())
+    assert((box_score.date, box_score.away, box_score.home) == ('2021-08-17 (2)', 'BOS', 'NYY'))
+    assert(box_score.night == 1.0 and box_score.temp == 72 and not box_score.playoffs)
+    assert(box_score.away_starter == ('Chris Sale', 'salech01') and box_score.home_starter == ('Gerrit Cole', 'colege01'))
+    assert(box_score.away_pitchers == [{'name': 'Chris Sale', 'id': 'salech01', 'IP': 6.1, 'ER': 2.0, 'H': 5.0, 'BB': 1.0, 'outs': 19}])
+    assert([pitcher['outs'] for pitcher in box_score.home_pitchers] == [21])
+
+    suspended = data_utils.parse_box_score(box_score_page(meta='<div>Game suspended, completed on August 18</div>'))
+    assert(suspended.suspended and suspended.date is None)
+    with pytest.raises(ValueError):
+        data_utils.parse_box_score(box_score_page(weather=None))
+
+
 # =========================== OFFENSIVE TESTS =========================== #
 
 
+def test_offensive_stats():
+    """
+    Test that the prefix-sum offensive stats match the scalar stat functions.
+    """
+    games = {}
+    for i in range(20):
+        H, doubles = rand.randint(0, 15), rand.randint(0, 3)
+        games[f'2021-04-{i+1:02d}'] = {'H': H, 'AB': rand.randint(H+1, 45), 'BB': rand.randint(0, 8), 'SF': rand.randint(0, 2),
+                                       'HBP': rand.randint(0, 2), '2B': min(H, doubles), '3B': 0, 'HR': 0,
+                                       'home': i % 3 == 0, 'opp_starter_righty': i % 2, 'postgame_BA': .25,
+                                       'postgame_OBP': .3, 'postgame_SLG': .4, 'postgame_OPS': .7}
+    get_data.calculate_offensive_stats({'BOS': games})
+    games = list(games.values())
+    last = games[-1]
+    recent = games[-11:-1]
+    H, AB = sum(g['H'] for g in recent), sum(g['AB'] for g in recent)
+    BB, HBP, SF = sum(g['BB'] for g in recent), sum(g['HBP'] for g in recent), sum(g['SF'] for g in recent)
+    doubles = sum(g['2B'] for g in recent)
+    assert(last['10-day_BA'] == data_utils.calculate_BA(AB, H))
+    assert(last['10-day_OBP'] == data_utils.calculate_OBP(H, BB, HBP, AB, SF))
+    assert(last['10-day_SLG'] == data_utils.calculate_SLG(H-doubles, doubles, 0, 0, AB))
+    home = [g for g in games[:-1] if g['home']]
+    assert(last['home_BA'] == data_utils.calculate_BA(sum(g['AB'] for g in home), sum(g['H'] for g in home)))
+    assert('home_BA' not in games[0] and 'away_BA' not in games[1])
+    assert(games[1]['home_BA'] == data_utils.calculate_BA(games[0]['AB'], games[0]['H']))
+
+
+def test_ewma_form():
+    """
+    Test that exponentially weighted stats weigh each earlier game by half
+    per half-life.
+    """
+    games = {'2021-04-01': {'H': 4, 'AB': 10, 'BB': 0, 'SF': 0, 'HBP': 0, '2B': 0, '3B': 0, 'HR': 0},
+             '2021-04-02': {'H': 1, 'AB': 10, 'BB': 0, 'SF': 0, 'HBP': 0, '2B': 0, '3B': 0, 'HR': 0},
+             '2021-04-03': {'H': 0, 'AB': 10, 'BB': 0, 'SF': 0, 'HBP': 0, '2B': 0, '3B': 0, 'HR': 0}}
+    table = stats_utils.get_form_table({'BOS': games}, [1], [1])
+    assert(table.loc[('BOS', '2021-04-02'), 'ewma-1_BA'] == .4)
+    assert(table.loc[('BOS', '2021-04-03'), 'ewma-1_BA'] == data_utils.calculate_BA(15, 3))
+    assert(table.loc[('BOS', '2021-04-03'), '1-day_BA'] == .1)
+
+
+def test_aggregate_state():
+    """
+    Test that games added through the aggregate state get the same stats as
+    recalculating the whole season.
+    """
+    games = {}
+    for i in range(30):
+        H = rand.randint(0, 15)
+        games[f'2021-05-{i+1:02d}'] = {'H': H, 'AB': rand.randint(H+1, 45), 'BB': rand.randint(0, 8), 'SF': 0, 'HBP': 0,
+                                       '2B': 0, '3B': 0, 'HR': min(H, 1), 'home': i % 2, 'opp_starter_righty': i % 3 > 0,
+                                       'postgame_BA': .25, 'postgame_OBP': .3, 'postgame_SLG': .4, 'postgame_OPS': .7}
+    stored = {'BOS': dict(list(games.items())[:20])}
+    get_data.calculate_offensive_stats(stored)
+    state = state_utils.build_state(stored, {}, {})
+    stored['BOS'].update({date: dict(game) for date, game in list(games.items())[20:]})
+    state_utils.update_state(state, stored, {}, {})
+    get_data.calculate_offensive_stats({'BOS': games})
+    assert(stored['BOS'] == games)
+
+    # a game older than the last one folded in can't be added in order
+    stored['BOS']['2021-04-30'] = dict(games['2021-05-01'])
+    assert(not state_utils.update_state(state, stored, {}, {}))
+    assert(state['teams']['BOS']['games'] == 30 and state_utils.is_current(state, {'BOS': games}, {}, {}))
+
+
+def test_league_index():
+    """
+    Test that the league index only counts games from earlier dates and that
+    a league average line has an OPS+ of 100.
+    """
+    line = {'H': 2, 'AB': 8, 'BB': 2, 'SF': 0, 'HBP': 0, '2B': 1, '3B': 0, 'HR': 0}
+    season_games = {'BOS': {'2021-04-01': dict(line), '2021-04-02': dict(line, H=4)},
+                    'NYY': {'2021-04-01': dict(line, H=0, **{'2B': 0}), '2021-04-02 (2)': dict(line)}}
+    pitcher_data = {'ace': {'2021-04-01': {'outs': 27, 'ER': 3}}}
+    league_index = stats_utils.get_league_index(season_games, pitcher_data)
+    assert(league_index['2021-04-02']['OBP'] == 6/20)
+    assert(league_index['2021-04-02']['ERA'] == 3)
+    season_games['BOS']['2021-04-02'].update({'pregame_OBP': .3, 'pregame_SLG': .1875})
+    stats_utils.calculate_league_adjusted(season_games, pitcher_data, {})
+    assert(season_games['BOS']['2021-04-02']['pregame_OPS+'] == 100)
+
+
 # =========================== PITCHING TESTS =========================== #
 
 
@@ -104,15 +361,15 @@ def test_bullpen_season_stats():
                 choice = rand.randint(4, len(dates)-1)
                 chosen_date = dates[choice]
                 chosen_game = data[team][chosen_date]
-                season_IP, season_ER, season_BB, season_H = (0, 0, 0, 0)
+                season_outs, season_ER, season_BB, season_H = (0, 0, 0, 0)
                 for date in dates[:choice]:
                     game = data[team][date]
-                    season_IP = data_utils.add_IP(season_IP, game['game_IP'])
+                    season_outs += game['game_outs']
                     season_ER += game['game_ER']
                     season_BB += game['game_BB']
                     season_H += game['game_H']
-                assert(chosen_game['pregame_ERA'] == data_utils.calculate_ERA(season_ER, season_IP))
-                assert(chosen_game['pregame_WHIP'] == data_utils.calculate_WHIP(season_IP, season_BB, season_H))
+                assert(chosen_game['pregame_ERA'] == data_utils.calculate_ERA(season_ER, season_outs))
+                assert(chosen_game['pregame_WHIP'] == data_utils.calculate_WHIP(season_outs, season_BB, season_H))
 
 
 def check_bullpen(game, innings_pitched, hits, earned_runs, walks):
@@ -131,11 +388,11 @@ def test_bullpen_game_stats():
     selected games. Hard-coded stats calculated by hand to
     be compared with the scraped values.
     """
-    game1 = BULLPEN_DATA['2021']['ARI']['2021-04-06']
-    game2 = BULLPEN_DATA['2021']['SFG']['2021-07-04']
-    game3 = BULLPEN_DATA['2021']['BOS']['2021-08-17 (2)']
-    game4 = BULLPEN_DATA['2021']['BAL']['2021-08-14']
-    game5 = BULLPEN_DATA['2021']['SEA']['2021-04-23']
+    game1 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'ARI', '2021-04-06')
+    game2 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'SFG', '2021-07-04')
+    game3 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'BOS', '2021-08-17 (2)')
+    game4 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'BAL', '2021-08-14')
+    game5 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'SEA', '2021-04-23')
     check_bullpen(game1, 7.1, 5, 2, 4)
     check_bullpen(game2, .1, 0, 0, 1)
     check_bullpen(game3, 1.0, 1, 0, 0)
@@ -143,46 +400,133 @@ def test_bullpen_game_stats():
     check_bullpen(game5, 3.1, 5, 0, 0)
 
 
+def test_pitcher_stats():
+    """
+    Test that pitchers' pregame ERA and WHIP only count their own earlier
+    appearances.
+    """
+    pitcher_data = {
+        'ace': {'2021-04-01': {'outs': 16, 'ER': 2, 'H': 4, 'BB': 1}, '2021-04-06': {'outs': 20, 'ER': 1, 'H': 5, 'BB': 3},
+                '2021-04-11': {'outs': 21, 'ER': 0, 'H': 2, 'BB': 0}},
+        'opener': {'2021-04-02': {'outs': 0, 'ER': 1, 'H': 1, 'BB': 1}, '2021-04-03': {'outs': 3, 'ER': 0, 'H': 0, 'BB': 0}},
+    }
+    get_data.calculate_pitcher_stats(pitcher_data)
+    ace = list(pitcher_data['ace'].values())
+    assert('pregame_ERA' not in ace[0])
+    assert(ace[2]['pregame_ERA'] == data_utils.calculate_ERA(3, 36))
+    assert(ace[2]['pregame_WHIP'] == data_utils.calculate_WHIP(36, 4, 9))
+    assert('pregame_ERA' not in pitcher_data['opener']['2021-04-03'])
+
+
+def test_bullpen_workload():
+    """
+    Test that bullpen workload counts the outs from the last n days, with
+    the first game of a doubleheader counting for the second.
+    """
+    bullpen = {'BOS': {'2021-06-01': {'game_outs': 9}, '2021-06-03': {'game_outs': 4}, '2021-06-04': {'game_outs': 6},
+                       '2021-06-04 (2)': {'game_outs': 2}, '2021-06-07': {'game_outs': 5}}}
+    stats_utils.calculate_bullpen_workload(bullpen, [1, 3])
+    games = list(bullpen['BOS'].values())
+    assert([game['1-day_outs'] for game in games] == [0, 0, 4, 10, 0])
+    assert([game['3-day_outs'] for game in games] == [0, 9, 13, 19, 8])
+
+
+def test_starter_form():
+    """
+    Test that starter form covers the last n starts only, skipping relief
+    appearances and the first start, that a start is found when the
+    appearance has the teams swapped, and that since only updates the
+    starts from that date on.
+    """
+    season_games = {'NYY': {'2021-06-01': {'opp_starter_id': 'aaa01'}, '2021-06-06': {'opp_starter_id': 'aaa01'},
+                            '2021-06-08': {'opp_starter_id': 'bbb01'}, '2021-06-11': {'opp_starter_id': 'aaa01'},
+                            '2021-06-16': {'opp_starter_id': 'aaa01'}}}
+    lines = [(18, 3, 1, 5), (15, 0, 2, 3), (3, 2, 1, 2), (21, 1, 0, 4), (18, 4, 2, 6)]
+    pitcher_data = {'aaa01': {date: {'team': 'BOS', 'opp': 'NYY', 'outs': outs, 'ER': er, 'BB': bb, 'H': h}
+                              for date, (outs, er, bb, h) in zip(season_games['NYY'], lines)}}
+    pitcher_data['aaa01']['2021-06-11'].update({'team': 'NYY', 'opp': 'BOS'})
+    stats_utils.calculate_starter_form(season_games, pitcher_data, [2])
+    games = list(pitcher_data['aaa01'].values())
+    assert([game.get('last-2-starts_ERA') for game in games] == [None, 4.5, None, 2.45, .75])
+    assert([game.get('last-2-starts_WHIP') for game in games] == [None, 1, None, 1, .75])
+
+    del games[3]['last-2-starts_ERA'], games[4]['last-2-starts_ERA']
+    stats_utils.calculate_starter_form(season_games, pitcher_data, [2], since='2021-06-16')
+    assert('last-2-starts_ERA' not in games[3])
+    assert(games[4]['last-2-starts_ERA'] == .75)
+
+
 def test_ERA_fn():
     """
     Test that calculate_ERA() in utils.py works.
     """
-    assert(data_utils.calculate_ERA(1, 1) == 9)
-    assert(data_utils.calculate_ERA(2, 2.1) == 7.71)
-    assert(data_utils.calculate_ERA(0, 9) == 0)
-    assert(data_utils.calculate_ERA(1, 21) == .43)
-    assert(data_utils.calculate_ERA(23, 40) == 5.17)
-    assert(data_utils.calculate_ERA(258, 974) == 2.38)
+    assert(data_utils.calculate_ERA(1, 3) == 9)
+    assert(data_utils.calculate_ERA(2, 7) == 7.71)
+    assert(data_utils.calculate_ERA(0, 27) == 0)
+    assert(data_utils.calculate_ERA(1, 63) == .43)
+    assert(data_utils.calculate_ERA(23, 120) == 5.17)
+    assert(data_utils.calculate_ERA(258, 2922) == 2.38)
+
+
+def test_innings_conversions():
+    """
+    Test converting between innings pitched and outs.
+    """
+    assert(data_utils.ip_to_outs(5.1) == 16)
+    assert(data_utils.ip_to_outs(0.2) == 2)
+    assert(data_utils.outs_to_IP(16) == 5.1)
+    assert(data_utils.outs_to_IP(42) == 14.0)
+    assert(data_utils.add_IP(5.1, 8.2) == 14.0)
+    assert(data_utils.add_IP(4.1, -1.2) == 2.2)
+    assert(data_utils.to_decimal(2.1) == 2+1/3)
 
 
 def test_WHIP_fn():
     """
     Test that calculate_WHIP() in utils.py works.
     """
-    assert(data_utils.calculate_WHIP(7, 0, 0) == 0)
-    assert(data_utils.calculate_WHIP(1, 1, 0) == 1)
-    assert(data_utils.calculate_WHIP(9, 8, 4) == 1.33)
-    assert(data_utils.calculate_WHIP(21, 1, 0) == .05)
-    assert(data_utils.calculate_WHIP(428, 340, 98) == 1.02)
+    assert(data_utils.calculate_WHIP(21, 0, 0) == 0)
+    assert(data_utils.calculate_WHIP(3, 1, 0) == 1)
+    assert(data_utils.calculate_WHIP(27, 8, 4) == 1.33)
+    assert(data_utils.calculate_WHIP(63, 1, 0) == .05)
+    assert(data_utils.calculate_WHIP(1284, 340, 98) == 1.02)
+
+
+def test_array_stat_fns():
+    """
+    Test that the stat functions give the same results for arrays as they do
+    one value at a time, with nan where the denominator is zero.
+    """
+    at_bats, hits, walks = np.array([4, 31, 0, 523]), np.array([1, 9, 0, 151]), np.array([0, 3, 2, 64])
+    outs = np.array([3, 7, 0, 2922])
+    assert(data_utils.calculate_BA(at_bats, hits)[:2].tolist() == [.25, data_utils.calculate_BA(31, 9)])
+    assert(np.isnan(data_utils.calculate_BA(at_bats, hits)[2]))
+    assert(data_utils.calculate_ERA(hits, outs)[3] == data_utils.calculate_ERA(151, 2922))
+    assert(data_utils.calculate_WHIP(outs, walks, hits)[1] == data_utils.calculate_WHIP(7, 3, 9))
+    assert(np.isnan(data_utils.calculate_WHIP(outs, walks, hits)[2]))
+    for i in range(len(at_bats)):
+        if at_bats[i] > 0:
+            obp = data_utils.calculate_OBP(hits, walks, 0*hits, at_bats, 0*hits)[i]
+            assert(obp == data_utils.calculate_OBP(int(hits[i]), int(walks[i]), 0, int(at_bats[i]), 0))
 
 
 def test_ERA_stats():
     """
     Test that ERAs were calculated correctly. 
     """
-    game1 = PITCHER_DATA['2012']['verlaju01']['2012-05-08']
-    game2 = PITCHER_DATA['2015']['syndeno01']['2015-06-02']
-    game3 = PITCHER_DATA['2011']['kershcl01']['2011-05-18']
-    game4 = PITCHER_DATA['2017']['klubeco01']['2017-04-27']
+    game1 = data_utils.get_appearance(PITCHER_DATA, '2012', 'verlaju01', '2012-05-08')
+    game2 = data_utils.get_appearance(PITCHER_DATA, '2015', 'syndeno01', '2015-06-02')
+    game3 = data_utils.get_appearance(PITCHER_DATA, '2011', 'kershcl01', '2011-05-18')
+    game4 = data_utils.get_appearance(PITCHER_DATA, '2017', 'klubeco01', '2017-04-27')
     assert(game1['pregame_ERA'] == 2.38)
     assert(game2['pregame_ERA'] == 1.82)
     assert(game3['pregame_ERA'] == 2.75)
     assert(game4['pregame_ERA'] == 4.28)
 
-    game5 = BULLPEN_DATA['2021']['CIN']['2021-04-05']
-    game6 = BULLPEN_DATA['2021']['BOS']['2021-04-05']
-    game7 = BULLPEN_DATA['2018']['NYY']['2018-04-03']
-    game8 = BULLPEN_DATA['2012']['CLE']['2012-04-09']
+    game5 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'CIN', '2021-04-05')
+    game6 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'BOS', '2021-04-05')
+    game7 = data_utils.get_bullpen_game(BULLPEN_DATA, '2018', 'NYY', '2018-04-03')
+    game8 = data_utils.get_bullpen_game(BULLPEN_DATA, '2012', 'CLE', '2012-04-09')
     assert(game5['pregame_ERA'] == 2.63)
     assert(game6['pregame_ERA'] == 4.30)
     assert(game7['pregame_ERA'] == 7.42)
@@ -194,21 +538,254 @@ def test_WHIP_stats():
     Test that WHIPs were calculated correctly.
     """
 
-    game1 = PITCHER_DATA['2016']['scherma01']['2016-04-26']
-    game2 = PITCHER_DATA['2016']['scherma01']['2016-05-27']
-    game3 = PITCHER_DATA['2019']['verlaju01']['2019-04-13']
-    game4 = PITCHER_DATA['2010']['hernafe02']['2010-04-26']
+    game1 = data_utils.get_appearance(PITCHER_DATA, '2016', 'scherma01', '2016-04-26')
+    game2 = data_utils.get_appearance(PITCHER_DATA, '2016', 'scherma01', '2016-05-27')
+    game3 = data_utils.get_appearance(PITCHER_DATA, '2019', 'verlaju01', '2019-04-13')
+    game4 = data_utils.get_appearance(PITCHER_DATA, '2010', 'hernafe02', '2010-04-26')
     assert(game1['pregame_WHIP'] == 1.2)
     assert(game2['pregame_WHIP'] == 1.1)
     assert(game3['pregame_WHIP'] == 1.29)
     assert(game4['pregame_WHIP'] == 1.09)
 
-    game5 = BULLPEN_DATA['2021']['SEA']['2021-04-05']
-    game6 = BULLPEN_DATA['2021']['OAK']['2021-04-04']
-    game7 = BULLPEN_DATA['2014']['NYM']['2014-04-04']
-    game8 = BULLPEN_DATA['2015']['PHI']['2015-04-10']
+    game5 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'SEA', '2021-04-05')
+    game6 = data_utils.get_bullpen_game(BULLPEN_DATA, '2021', 'OAK', '2021-04-04')
+    game7 = data_utils.get_bullpen_game(BULLPEN_DATA, '2014', 'NYM', '2014-04-04')
+    game8 = data_utils.get_bullpen_game(BULLPEN_DATA, '2015', 'PHI', '2015-04-10')
     assert(game5['pregame_WHIP'] == .91)
     assert(game6['pregame_WHIP'] == 2.11)
     assert(game7['pregame_WHIP'] == 2.36)
     assert(game8['pregame_WHIP'] == 1.42)
 
+
+
+# =========================== INFRASTRUCTURE TESTS =========================== #
+
+
+def test_page_cache_worker():
+    """
+    Test that pages put by a forked worker process are in the index the
+    parent sees afterwards.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        cache = cache_utils.PageCache(folder)
+        worker = multiprocessing.get_context('fork').Process(target=cache.put, args=('https://a.com/boxes/1', b'box score', 'utf-8'))
+        worker.start()
+        worker.join()
+        assert(cache.get('https://a.com/boxes/1') is None)
+        cache.save_index()
+        assert(cache.get('https://a.com/boxes/1') == (b'box score', 'utf-8'))
+
+
+def test_page_ttl():
+    """
+    Test that box scores and past seasons never expire and that pages of
+    the current season expire daily.
+    """
+    year = datetime.date.today().year
+    assert(cache_utils.page_ttl('https://www.baseball-reference.com/boxes/BOS/BOS202108170.shtml') is None)
+    assert(cache_utils.page_ttl(f'https://www.baseball-reference.com/leagues/majors/{year-1}-schedule.shtml') is None)
+    assert(cache_utils.page_ttl(f'https://www.baseball-reference.com/leagues/majors/{year}-schedule.shtml') == cache_utils.DAY)
+    assert(cache_utils.page_ttl(f'https://www.baseball-reference.com/teams/tgl.cgi?team=BOS&t=b&year={year}') == cache_utils.DAY)
+
+
+def test_page_cache(tmp_path):
+    """
+    Test that pages are stored once per content, counted once in the cache
+    size, and that the least recently used ones are evicted past max_bytes.
+    """
+    pages = [os.urandom(1000) for _ in range(3)]
+    cache = cache_utils.PageCache(str(tmp_path), max_bytes=2500)
+    cache.put('https://a.com/boxes/a', pages[0], 'utf-8')
+    cache.put('https://a.com/boxes/b', pages[0], 'utf-8')
+    cache.put('https://a.com/boxes/c', pages[1], 'utf-8')
+    first, second = cache.index['https://a.com/boxes/a'], cache.index['https://a.com/boxes/c']
+    assert(cache.refs[first['hash']] == 2 and cache.total_bytes == first['size'] + second['size'])
+    assert(cache.get('https://a.com/boxes/a') == (pages[0], 'utf-8') and cache.get('https://a.com/boxes/d') is None)
+
+    # b and c are the least recently used, and dropping b alone frees nothing
+    cache.put('https://a.com/boxes/d', pages[2], 'utf-8')
+    assert(list(cache.index) == ['https://a.com/boxes/a', 'https://a.com/boxes/d'])
+    assert(cache.get('https://a.com/boxes/c') is None and not os.path.isfile(cache.blob_file(second['hash'])))
+    assert(cache.total_bytes == first['size'] + cache.index['https://a.com/boxes/d']['size'])
+    cache.save_index()
+    assert(cache_utils.PageCache(str(tmp_path)).refs == cache.refs)
+
+
+def test_checkpoint_and_quarantine(tmp_path, monkeypatch):
+    """
+    Test that a box score that can't be parsed is quarantined without
+    stopping the scrape, that checkpoints record the progress, and that
+    resuming skips the games before the checkpoint.
+    """
+    monkeypatch.chdir(tmp_path)
+    cache = cache_utils.PageCache(str(tmp_path / 'pages'))
+    game_ids = ['boxes/NYA/NYA202108160.shtml', 'boxes/NYA/NYA202108172.shtml']
+    schedule = ''.join(f'<p class="game"><a>BOS</a> @ <a>NYY</a> <a href="{game_id}">Boxscore</a></p>' for game_id in game_ids)
+    cache.put('https://www.baseball-reference.com/leagues/majors/2021-schedule.shtml', schedule.encode(), 'utf-8')
+    cache.put('https://www.baseball-reference.com/' + game_ids[0], box_score_page(weather=None).encode(), 'utf-8')
+    cache.put('https://www.baseball-reference.com/' + game_ids[1], box_score_page().encode(), 'utf-8')
+    monkeypatch.setattr(get_data, 'SESSION', cache_utils.CachedSession(cache=cache, offline=True))
+
+    season_games = {'BOS': {'2021-08-17 (2)': {}}, 'NYY': {'2021-08-17 (2)': {}}}
+    quarantine = []
+    pitching = get_data.get_season_pitching('2021', season_games, 1, quarantine=quarantine, checkpoint_every=1)
+    assert([entry['game_id'] for entry in quarantine] == [game_ids[0]] and 'ValueError' in quarantine[0]['error'])
+    assert(pitching['salech01']['2021-08-17 (2)']['outs'] == 19 and season_games['NYY']['2021-08-17 (2)']['opp_starter_id'] == 'salech01')
+    checkpoint = data_utils.load_checkpoint('2021')
+    assert(checkpoint['last_game_id'] == game_ids[0] and checkpoint['quarantine'] == quarantine)
+
+    season_games = {'BOS': {'2021-08-17 (2)': {}}, 'NYY': {'2021-08-17 (2)': {}}}
+    quarantine = []
+    pitching = get_data.get_season_pitching('2021', season_games, 1, quarantine=quarantine, resume_after=checkpoint['last_game_id'])
+    assert(quarantine == [] and 'colege01' in pitching)
+    data_utils.remove_checkpoint('2021')
+    assert(data_utils.load_checkpoint('2021') is None)
+
+
+class StubAdapter(requests.adapters.BaseAdapter):
+    """
+    Answers each request with the next of the given status codes (or raises
+    it if it's an exception), without going to the network.
+    """
+    def __init__(self, answers, retry_after=None):
+        super().__init__()
+        self.answers = list(answers)
+        self.retry_after = retry_after
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        answer = self.answers[min(self.sent, len(self.answers)-1)]
+        self.sent += 1
+        if isinstance(answer, Exception):
+            raise answer
+        response = requests.models.Response()
+        response.status_code = answer
+        response._content = b'page'
+        response.url, response.request = request.url, request
+        if self.retry_after is not None:
+            response.headers['Retry-After'] = self.retry_after
+        return response
+
+    def close(self):
+        pass
+
+
+def test_rate_limited_session(monkeypatch):
+    """
+    Test that throttling, server errors and connection errors are retried
+    up to max_retries, and that Retry-After is used for the backoff.
+    """
+    monkeypatch.setattr(request_utils, 'BACKOFF_BASE', 0)
+    session = request_utils.RateLimitedSession(max_retries=3)
+    adapter = StubAdapter([429, 503, requests.exceptions.ConnectionError(), 200], retry_after='0')
+    session.mount('https://', adapter)
+    assert(session.get('https://a.com/page').status_code == 200)
+    assert(adapter.sent == 4 and session.stats.retries == 3 and session.stats.requests == 3)
+
+    session = request_utils.RateLimitedSession(max_retries=2)
+    adapter = StubAdapter([500])
+    session.mount('https://', adapter)
+    assert(session.get('https://a.com/page').status_code == 500 and adapter.sent == 3)
+
+    response = requests.models.Response()
+    response.headers['Retry-After'] = '7'
+    assert(request_utils.get_backoff(0, response) == 7)
+    monkeypatch.setattr(request_utils, 'BACKOFF_BASE', 2)
+    assert(4 <= request_utils.get_backoff(2) <= 12)
+
+
+def test_token_bucket():
+    """
+    Test that each host gets its own rate, and that a throttled host's
+    rate is halved and its next request waits out the backoff delay.
+    """
+    bucket = request_utils.TokenBucket(20)
+    start = time.monotonic()
+    bucket.wait('https://a.com/1')
+    bucket.wait('https://b.com/1')
+    assert(time.monotonic() - start < .04)
+    bucket.wait('https://a.com/2')
+    assert(time.monotonic() - start >= .04)
+
+    bucket.throttled('https://a.com/2', .2)
+    assert(bucket.hosts['a.com']['rate'] == 10)
+    start = time.monotonic()
+    bucket.wait('https://a.com/3')
+    assert(time.monotonic() - start >= .18)
+    bucket.succeeded('https://a.com/3')
+    assert(bucket.hosts['a.com']['rate'] == 11)
+
+
+def test_metadata_cache(tmp_path):
+    """
+    Test that metadata entries are kept by kind, are seen by other caches on
+    the same file, and can be cleared one at a time, by kind or all at once.
+    """
+    path = str(tmp_path / 'metadata.json')
+    cache = cache_utils.MetadataCache(path)
+    assert(cache.get('teams', '2021') is None)
+    cache.put('teams', '2021', ['ARI', 'ATL'])
+    cache.put('teams', '2022', ['BOS'])
+    cache.put('rosters', 'BOS', ['salech01'])
+    other = cache_utils.MetadataCache(path)
+    assert(other.get('teams', '2021') == ['ARI', 'ATL'] and other.get('rosters', 'BOS') == ['salech01'])
+
+    cache.clear('teams', '2021')
+    assert(cache.get('teams', '2021') is None and cache.get('teams', '2022') == ['BOS'])
+    cache.clear('teams')
+    assert(cache.get('teams', '2022') is None and cache.get('rosters', 'BOS') == ['salech01'])
+    cache.clear()
+    assert(cache_utils.MetadataCache(path).get('rosters', 'BOS') is None)
+
+
+def test_season_store(tmp_path, monkeypatch):
+    """
+    Test that a season store only loads a file of a season the first time
+    it's looked up, and that evicting a season drops its data and index.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data/2021')
+    data_utils.dump_data('2021', 'game-data.json', {'BOS': {'2021-08-17': {'R': 3}, '2021-08-17 (2)': {'R': 5}}})
+    data_utils.dump_data('2021', 'pitcher-data.json', {'salech01': {'2021-08-17': {'IP': 6.1, 'ER': 2.0}}})
+    data_utils.dump_data('2021', 'team-bullpen-data.json', {'BOS': {'2021-08-17': {'game_IP': 3.0, 'game_ER': 0.0}}})
+    store = storage_utils.SeasonStore(2021, 2021)
+    assert(list(store.games) == ['2021'] and not store.is_loaded('2021', 'games'))
+    assert(store.games['2021']['BOS']['2021-08-17 (2)'] == {'R': 5})
+    assert(store.is_loaded('2021', 'games') and not store.is_loaded('2021', 'pitchers'))
+    assert(store.pitchers['2021']['salech01']['2021-08-17']['outs'] == 19)
+    with pytest.raises(KeyError):
+        store.games['2019']
+
+    assert(store.index.get_game('2021', 'BOS', data_utils.to_game_key('2021-08-17')) == {'R': 3})
+    store.evict('2021')
+    assert(not store.is_loaded('2021', 'games') and not store.is_loaded('2021', 'pitchers') and store.index.team_keys == {})
+    store.preload(entities=['bullpens'])
+    assert(store.is_loaded('2021', 'bullpens') and not store.is_loaded('2021', 'games'))
+
+    compact = storage_utils.SeasonStore(2021, 2021, compact=True)
+    assert(isinstance(compact.games['2021'], table_utils.GameTable) and compact.games['2021'] == store.games['2021'])
+
+
+def test_array_cache(tmp_path):
+    """
+    Test that arrays come back memory-mapped under their fingerprint, that
+    storing a new fingerprint replaces the old one, and that fingerprints
+    change with the values and files they're built from.
+    """
+    cache = cache_utils.ArrayCache(str(tmp_path / 'arrays'))
+    file = tmp_path / 'game-data.json'
+    file.write_text('{}')
+    old_key = cache_utils.fingerprint([2021, ['temp']], [str(file)])
+    assert(old_key == cache_utils.fingerprint([2021, ['temp']], [str(file)]))
+    assert(old_key != cache_utils.fingerprint([2021, ['temp', 'has_DH']], [str(file)]))
+    assert(cache.load('samples', old_key) is None)
+
+    stored = cache.store('samples', old_key, {'features': np.arange(6.).reshape(3, 2), 'runs': np.array([1, 4, 2])})
+    assert(isinstance(stored['features'], np.memmap) and stored['runs'].tolist() == [1, 4, 2])
+    assert(cache.load('samples', old_key)['features'][2, 1] == 5)
+
+    file.write_text('{"BOS": {}}')
+    new_key = cache_utils.fingerprint([2021, ['temp']], [str(file)])
+    assert(new_key != old_key)
+    cache.store('samples', new_key, {'runs': np.array([3])})
+    assert(cache.load('samples', old_key) is None and cache.load('samples', new_key)['runs'].tolist() == [3])